@@ -1,78 +1,801 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g, Response, stream_with_context
 from flask_cors import CORS
+import click
 import sqlite3
 import os
-from datetime import datetime, time
+import json
+import math
+import base64
+import codecs
+import contextvars
+import csv
+from datetime import date, datetime, time, timezone
 import re
+import queue
+import time as time_module
+import threading
+import multiprocessing
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from werkzeug.local import LocalProxy
+
+import availability
+import campuses
+import events
+import exports
+import metrics
+import migrations
+import snapshot
+import solver
+import writer
+from perprocess import PerProcess
+from schedule_index import ScheduleIndex, TEACHER, ROOM, overlaps_involving
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+CORS(app, resources={r"/api/*": {"origins": "*"}}, expose_headers=['X-Next-Cursor'])
+app.wsgi_app = campuses.PrefixMiddleware(app.wsgi_app)
 
 # Database configuration
-DATABASE = 'scheduling.db'
+DATABASE = os.environ.get('DATABASE', 'scheduling.db')
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+# Connection settings, each overridable through an environment variable
+app.config.update(
+    DATABASE=DATABASE,
+    SQLITE_JOURNAL_MODE=os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    SQLITE_SYNCHRONOUS=os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    SQLITE_FOREIGN_KEYS=os.environ.get('SQLITE_FOREIGN_KEYS', '1') == '1',
+    SQLITE_CACHE_SIZE=int(os.environ.get('SQLITE_CACHE_SIZE', -20000)),       # negative = KiB
+    SQLITE_MMAP_SIZE=int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    SQLITE_BUSY_TIMEOUT=float(os.environ.get('SQLITE_BUSY_TIMEOUT', 5.0)),     # seconds
+    SQLITE_CACHED_STATEMENTS=int(os.environ.get('SQLITE_CACHED_STATEMENTS', 256)),
+    SQLITE_POOL_SIZE=int(os.environ.get('SQLITE_POOL_SIZE', 8)),
+    METRICS_ENABLED=os.environ.get('METRICS_ENABLED', '1') == '1',
+    SLOW_REQUEST_MS=float(os.environ.get('SLOW_REQUEST_MS', 500)),   # 0 disables the slow log
+    # Directory where every worker process dumps its metrics, so a scrape of
+    # any worker reports all of them (gunicorn.conf.py sets one up)
+    METRICS_DIR=os.environ.get('METRICS_DIR') or None,
+    METRICS_EXPORT_INTERVAL=float(os.environ.get('METRICS_EXPORT_INTERVAL', 1.0)),   # seconds
+    MIGRATION_CHUNK_SIZE=int(os.environ.get('MIGRATION_CHUNK_SIZE', 5000)),  # rows per committed chunk
+    WRITE_GROUP_SIZE=int(os.environ.get('WRITE_GROUP_SIZE', 64)),   # writes per writer transaction
+    # Multi-campus mode: "name=path,..." gives every campus its own database
+    # file instead of DATABASE (see campuses.py for how requests pick one)
+    CAMPUSES=campuses.parse(os.environ.get('CAMPUSES', '')),
+    DEFAULT_CAMPUS=os.environ.get('DEFAULT_CAMPUS') or None,   # for requests naming no campus
+    CAMPUS_FANOUT_THREADS=int(os.environ.get('CAMPUS_FANOUT_THREADS', 8)),
+    # Serve GET requests from a per-process in-memory copy (see snapshot.py)
+    # that may trail the file by at most READ_SNAPSHOT_MAX_STALENESS seconds
+    READ_SNAPSHOT=os.environ.get('READ_SNAPSHOT', '0') == '1',
+    READ_SNAPSHOT_MAX_STALENESS=float(os.environ.get('READ_SNAPSHOT_MAX_STALENESS', 0)),
+)
+
+# Write generations per table, shared with forked worker processes. Every
+# successful write bumps its table; list responses are cached per generation.
+GENERATION_TABLES = ('teachers', 'courses', 'timeframes', 'rooms', 'batches')
+# Distinguishes ETags issued before and after a restart
+_etag_epoch = os.urandom(4).hex()
+
+class Shard:
+    """One database file and the per-process state kept for it.
+    
+    That is the idle connection pool, the writer thread, the schedule index
+    behind the availability and timetable views, the per-table write
+    generations, the change feed and the optional read snapshot. A single-database deployment has one
+    shard for DATABASE; multi-campus mode has one per campus, so campuses
+    share neither write locks nor caches. Shards are created before the
+    server forks, which hands the shared counters to every worker.
+    """
+    
+    def __init__(self, name, database):
+        self.name = name
+        self.database = database
+        # Idle connections kept open between requests
+        self.pool = queue.LifoQueue()
+        self.schedule_index = ScheduleIndex()
+        self.occupancy_cache = availability.OccupancyCache(self.schedule_index)
+        self.generations = multiprocessing.RawArray('q', len(GENERATION_TABLES))
+        self.generation_lock = multiprocessing.Lock()
+        # Generations of INDEX_TABLES the schedule index reflects, and the
+        # last change record it has been brought up to date with
+        self.index_generation = None
+        self.index_event_id = 0
+        self.index_reload_lock = threading.Lock()
+        # Newest change record id, shared with forked workers like the generations
+        self.change_feed = events.ChangeFeed(self.connect, multiprocessing.RawValue('q', 0))
+        # Every route mutation goes through one writer thread per shard and
+        # process, which commits concurrent writes together
+        self.writer = writer.WriteQueue(self.connect, app.config['WRITE_GROUP_SIZE'])
+        # In-memory copy for GET requests, versioned by the write generations
+        self.snapshot = snapshot.ReadSnapshot(
+            self.connect, lambda: tuple(self.generations),
+            app.config['READ_SNAPSHOT_MAX_STALENESS'], app.config['SQLITE_POOL_SIZE']
+        ) if app.config['READ_SNAPSHOT'] else None
+        # The same URL serves every campus, so their ETags must differ
+        self.etag_prefix = _etag_epoch if name is None else f"{_etag_epoch}-{name}"
+    
+    def connect(self, database=None):
+        """Open a connection to this shard's file, or to ``database`` (e.g. its snapshot)"""
+        return connect_db(database or self.database)
+
+# Shards by campus name (None in single-database mode) and the one the
+# current request, writer job or fan-out task works on
+_shards = {}
+_current_shard = contextvars.ContextVar('shard', default=None)
+# Settings the shards were created with
+SHARD_SETTINGS = ('CAMPUSES', 'DATABASE', 'WRITE_GROUP_SIZE', 'SQLITE_POOL_SIZE',
+                  'READ_SNAPSHOT', 'READ_SNAPSHOT_MAX_STALENESS')
+_shard_settings = None
+
+def configure_shards():
+    """Create the shards app.config asks for, keeping them if it has not changed"""
+    global _shard_settings
+    settings = [app.config[key] for key in SHARD_SETTINGS]
+    if settings == _shard_settings:
+        return
+    close_idle_connections()
+    _shards.clear()
+    for name, database in (app.config['CAMPUSES'] or {None: app.config['DATABASE']}).items():
+        _shards[name] = Shard(name, database)
+    _shard_settings = settings
+
+def current_shard():
+    """The shard selected for the current request, or the only one there is"""
+    shard = _current_shard.get()
+    if shard is not None:
+        return shard
+    if len(_shards) == 1:
+        return next(iter(_shards.values()))
+    raise LookupError("No campus selected")
+
+@contextmanager
+def using_shard(shard):
+    """Make ``shard`` current for the block, e.g. for startup work or a fan-out task"""
+    token = _current_shard.set(shard)
+    try:
+        yield shard
+    finally:
+        _current_shard.reset(token)
+
+# The current shard's state, usable like request and g
+schedule_index = LocalProxy(lambda: current_shard().schedule_index)
+occupancy_cache = LocalProxy(lambda: current_shard().occupancy_cache)
+change_feed = LocalProxy(lambda: current_shard().change_feed)
+db_writer = LocalProxy(lambda: current_shard().writer)
+
+def close_idle_connections():
+    """Close every pooled connection, e.g. before the server forks its workers"""
+    for shard in _shards.values():
+        while True:
+            try:
+                shard.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+def _reset_pool_after_fork():
+    # SQLite connections must not cross a fork; the child starts with empty
+    # pools and leaves the parent's handles alone
+    for shard in _shards.values():
+        shard.pool = queue.LifoQueue()
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
+configure_shards()
+
+def connect_db(database=None):
+    """Open a new connection to ``database`` (default: the current shard's) with the configured pragmas applied"""
+    config = app.config
+    database = database or current_shard().database
+    conn = sqlite3.connect(
+        database,
+        timeout=config['SQLITE_BUSY_TIMEOUT'],
+        cached_statements=config['SQLITE_CACHED_STATEMENTS'],
+        check_same_thread=False,
+        uri=database.startswith('file:'),
+        factory=metrics.InstrumentedConnection if config['METRICS_ENABLED'] else sqlite3.Connection
+    )
+    if config['METRICS_ENABLED']:
+        metrics.instrument(conn)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA foreign_keys = {'ON' if config['SQLITE_FOREIGN_KEYS'] else 'OFF'}")
+    conn.execute(f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}")
     return conn
 
+def get_db():
+    """Return the connection for the current request, reusing a pooled one if possible"""
+    if 'db' not in g:
+        shard = current_shard()
+        try:
+            g.db = shard.pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db(shard.database)
+        g.db_pool = shard.pool
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    """Hand the request connection back to its shard's pool"""
+    db = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    copy = g.pop('db_snapshot', None)
+    if db is None:
+        return
+    if copy is not None:
+        # The copy came with the connection; the campus may already be reset
+        copy.release(db)
+        return
+    if db.in_transaction:
+        db.rollback()
+    if pool.qsize() < app.config['SQLITE_POOL_SIZE']:
+        pool.put(db)
+    else:
+        db.close()
+
+# Endpoints that work without a campus in multi-campus mode
+CAMPUS_FREE_ENDPOINTS = {'health', 'ready', 'metrics_endpoint', 'list_campuses', 'campus_teacher_lookup'}
+
+@app.before_request
+def select_shard():
+    """Route the request to its campus database"""
+    if not app.config['CAMPUSES']:
+        # A single database has no campus to name in the URL
+        if campuses.ENVIRON_KEY in request.environ:
+            return jsonify({"error": f"Unknown campus: {request.environ[campuses.ENVIRON_KEY]}"}), 404
+        return
+    name = (request.environ.get(campuses.ENVIRON_KEY) or request.headers.get(campuses.HEADER)
+            or app.config['DEFAULT_CAMPUS'])
+    if name is None:
+        if request.path.startswith('/api/') and request.endpoint not in CAMPUS_FREE_ENDPOINTS:
+            return jsonify({
+                "error": f"No campus selected; use a /campus/<name> prefix or an {campuses.HEADER} header",
+                "campuses": list(_shards)
+            }), 400
+        return
+    shard = _shards.get(name)
+    if shard is None:
+        return jsonify({"error": f"Unknown campus: {name}"}), 404
+    g.shard_token = _current_shard.set(shard)
+
+@app.before_request
+def use_read_snapshot():
+    """Point GET requests at the shard's in-memory copy while it is current enough"""
+    if (not app.config['READ_SNAPSHOT'] or request.method not in ('GET', 'HEAD')
+            or not request.path.startswith('/api/') or request.endpoint in CAMPUS_FREE_ENDPOINTS):
+        return
+    acquired = current_shard().snapshot.acquire()
+    if acquired is not None:
+        # get_db() returns it; nested app contexts (index reloads) still read the file
+        g.db, g.db_snapshot = acquired
+
+@app.after_request
+def vary_on_campus(response):
+    if app.config['CAMPUSES']:
+        response.vary.add(campuses.HEADER)
+    return response
+
+@app.teardown_request
+def release_shard(exception):
+    token = g.pop('shard_token', None)
+    if token is not None:
+        _current_shard.reset(token)
+
 def init_db():
-    with app.app_context():
-        db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS teachers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            phone TEXT NOT NULL,
-            UNIQUE(name, phone)
-        )""")
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS courses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,
-            description TEXT,
-            active BOOLEAN DEFAULT 1
-        )""")
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS timeframes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timeframe TEXT NOT NULL UNIQUE,
-            start_time TEXT NOT NULL,
-            end_time TEXT NOT NULL,
-            CHECK(start_time < end_time)
-        )""")
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS rooms (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            room_number TEXT NOT NULL UNIQUE
-        )""")
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS batches (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            course_id INTEGER NOT NULL,
-            timeframe_id INTEGER NOT NULL,
-            room_id INTEGER NOT NULL,
-            batch_number TEXT NOT NULL,
-            days TEXT NOT NULL,
-            teacher_ids TEXT NOT NULL,
-            active BOOLEAN DEFAULT 1,
-            FOREIGN KEY (course_id) REFERENCES courses(id),
-            FOREIGN KEY (timeframe_id) REFERENCES timeframes(id),
-            FOREIGN KEY (room_id) REFERENCES rooms(id),
-            UNIQUE(course_id, batch_number)
+    """Bring every shard's schema up to date; a current database costs one PRAGMA read"""
+    configure_shards()
+    for shard in _shards.values():
+        with using_shard(shard), app.app_context():
+            migrations.migrate(get_db(), SCHEMA_MIGRATIONS, log=app.logger.info)
+
+# Schema migrations, applied in order by migrations.migrate(). Released
+# steps are never edited; schema changes get a new step. Every step also
+# brings databases created before versioning (user_version 0) up to date.
+def migration_base_tables(db):
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS teachers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        UNIQUE(name, phone)
+    )""")
+    
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS courses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        description TEXT,
+        active BOOLEAN DEFAULT 1
+    )""")
+    
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS timeframes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timeframe TEXT NOT NULL UNIQUE,
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        start_min INTEGER CHECK(start_min BETWEEN 0 AND 1439),
+        end_min INTEGER CHECK(end_min > start_min AND end_min <= 1440),
+        start_label TEXT,
+        end_label TEXT,
+        CHECK(start_time < end_time)
+    )""")
+    
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS rooms (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room_number TEXT NOT NULL UNIQUE,
+        capacity INTEGER
+    )""")
+    
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        course_id INTEGER NOT NULL,
+        timeframe_id INTEGER NOT NULL,
+        room_id INTEGER NOT NULL,
+        batch_number TEXT NOT NULL,
+        days TEXT NOT NULL,
+        teacher_ids TEXT NOT NULL,
+        active BOOLEAN DEFAULT 1,
+        FOREIGN KEY (course_id) REFERENCES courses(id),
+        FOREIGN KEY (timeframe_id) REFERENCES timeframes(id),
+        FOREIGN KEY (room_id) REFERENCES rooms(id),
+        UNIQUE(course_id, batch_number)
+    )""")
+
+def migration_batch_links(db):
+    """Normalized lookups for batches.teacher_ids / batches.days, backfilled in chunks"""
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS batch_teachers (
+        batch_id INTEGER NOT NULL,
+        teacher_id INTEGER NOT NULL,
+        PRIMARY KEY (batch_id, teacher_id),
+        FOREIGN KEY (batch_id) REFERENCES batches(id) ON DELETE CASCADE
+    )""")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_batch_teachers_teacher ON batch_teachers(teacher_id, batch_id)")
+    
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS batch_days (
+        batch_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        PRIMARY KEY (batch_id, day),
+        FOREIGN KEY (batch_id) REFERENCES batches(id) ON DELETE CASCADE
+    )""")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_batch_days_day ON batch_days(day, batch_id)")
+    
+    last_id = 0
+    while True:
+        pending = db.execute("""
+            SELECT b.id, b.days, b.teacher_ids
+            FROM batches b
+            WHERE b.id > ?
+              AND (NOT EXISTS (SELECT 1 FROM batch_days bd WHERE bd.batch_id = b.id)
+                   OR NOT EXISTS (SELECT 1 FROM batch_teachers bt WHERE bt.batch_id = b.id))
+            ORDER BY b.id
+            LIMIT ?
+        """, (last_id, app.config['MIGRATION_CHUNK_SIZE'])).fetchall()
+        if not pending:
+            return
+        for batch in pending:
+            sync_batch_links(
+                db,
+                batch['id'],
+                split_ids(batch['teacher_ids']),
+                [day.strip() for day in batch['days'].split(',') if day.strip()]
+            )
+        last_id = pending[-1]['id']
+        yield len(pending)
+
+def migration_timeframe_minutes(db):
+    """Minute-of-day columns and 12-hour labels, backfilled in chunks"""
+    columns = [column['name'] for column in db.execute("PRAGMA table_info(timeframes)").fetchall()]
+    for column, definition in [
+        ('start_min', "INTEGER CHECK(start_min BETWEEN 0 AND 1439)"),
+        ('end_min', "INTEGER CHECK(end_min > start_min AND end_min <= 1440)"),
+        ('start_label', "TEXT"),
+        ('end_label', "TEXT"),
+    ]:
+        if column not in columns:
+            db.execute(f"ALTER TABLE timeframes ADD COLUMN {column} {definition}")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_timeframes_minutes ON timeframes(start_min, end_min)")
+    
+    while True:
+        pending = db.execute(
+            "SELECT id, start_time, end_time FROM timeframes WHERE start_min IS NULL OR start_label IS NULL LIMIT ?",
+            (app.config['MIGRATION_CHUNK_SIZE'],)
+        ).fetchall()
+        if not pending:
+            return
+        db.executemany(
+            "UPDATE timeframes SET start_min = ?, end_min = ?, start_label = ?, end_label = ? WHERE id = ?",
+            [
+                (time_to_minutes(tf['start_time']), time_to_minutes(tf['end_time']),
+                 format_time_12h(tf['start_time']), format_time_12h(tf['end_time']), tf['id'])
+                for tf in pending
+            ]
+        )
+        yield len(pending)
+
+def migration_room_capacity(db):
+    columns = [column['name'] for column in db.execute("PRAGMA table_info(rooms)").fetchall()]
+    if 'capacity' not in columns:
+        db.execute("ALTER TABLE rooms ADD COLUMN capacity INTEGER")
+
+def migration_change_events(db):
+    """Change records streamed by /api/events"""
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS change_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        op TEXT NOT NULL,
+        entity_id INTEGER,
+        data TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""")
+
+def migration_occupancy(db):
+    """One row per (active batch, teacher, day) with the timeframe minutes
+    copied in, kept current by triggers and rebuilt here in chunks"""
+    db.execute("CREATE INDEX IF NOT EXISTS idx_batches_timeframe ON batches(timeframe_id)")
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS occupancy (
+        teacher_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        start_min INTEGER NOT NULL,
+        end_min INTEGER NOT NULL,
+        batch_id INTEGER NOT NULL,
+        room_id INTEGER,
+        PRIMARY KEY (batch_id, teacher_id, day)
+    ) WITHOUT ROWID""")
+    db.execute("""CREATE INDEX IF NOT EXISTS idx_occupancy_teacher
+        ON occupancy(teacher_id, day, start_min, end_min, batch_id)""")
+    db.execute("""CREATE INDEX IF NOT EXISTS idx_occupancy_day
+        ON occupancy(day, start_min, end_min, teacher_id, batch_id, room_id)""")
+    db.execute("""CREATE INDEX IF NOT EXISTS idx_occupancy_room
+        ON occupancy(room_id, day, start_min, end_min, batch_id)""")
+    create_occupancy_triggers(db)
+    
+    # Rows written by the triggers between chunks are recomputed by a
+    # later chunk (INSERT OR REPLACE), so nothing is lost or doubled
+    db.execute("DELETE FROM occupancy")
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.execute(
+            "SELECT id FROM batches WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, app.config['MIGRATION_CHUNK_SIZE'])
+        ).fetchall()]
+        if not ids:
+            return
+        db.execute(
+            "INSERT OR REPLACE INTO occupancy (teacher_id, day, start_min, end_min, batch_id, room_id) "
+            + OCCUPANCY_SELECT.format(condition='b.id BETWEEN ? AND ?'),
+            (ids[0], ids[-1])
+        )
+        last_id = ids[-1]
+        yield len(ids)
+
+# Occupancy rows for the active batches matching a condition on b (batches)
+OCCUPANCY_SELECT = """
+    SELECT bt.teacher_id, bd.day, t.start_min, t.end_min, b.id, b.room_id
+    FROM batches b
+    JOIN timeframes t ON t.id = b.timeframe_id
+    JOIN batch_teachers bt ON bt.batch_id = b.id
+    JOIN batch_days bd ON bd.batch_id = b.id
+    WHERE b.active = 1 AND t.start_min IS NOT NULL AND {condition}
+"""
+
+def create_occupancy_triggers(db):
+    """Keep the occupancy table in step with batches, their links and timeframe edits"""
+    insert = "INSERT OR REPLACE INTO occupancy (teacher_id, day, start_min, end_min, batch_id, room_id)"
+    triggers = {
+        # Links are written after the batch row, so the link triggers fill in
+        # new batches; the batch triggers handle edits and deletes
+        'occupancy_teacher_insert': f"""AFTER INSERT ON batch_teachers BEGIN
+            {insert} {OCCUPANCY_SELECT.format(condition='b.id = NEW.batch_id AND bt.teacher_id = NEW.teacher_id')};
+        END""",
+        'occupancy_teacher_delete': """AFTER DELETE ON batch_teachers BEGIN
+            DELETE FROM occupancy WHERE batch_id = OLD.batch_id AND teacher_id = OLD.teacher_id;
+        END""",
+        'occupancy_day_insert': f"""AFTER INSERT ON batch_days BEGIN
+            {insert} {OCCUPANCY_SELECT.format(condition='b.id = NEW.batch_id AND bd.day = NEW.day')};
+        END""",
+        'occupancy_day_delete': """AFTER DELETE ON batch_days BEGIN
+            DELETE FROM occupancy WHERE batch_id = OLD.batch_id AND day = OLD.day;
+        END""",
+        'occupancy_batch_update': f"""AFTER UPDATE OF timeframe_id, room_id, active ON batches BEGIN
+            DELETE FROM occupancy WHERE batch_id = NEW.id;
+            {insert} {OCCUPANCY_SELECT.format(condition='b.id = NEW.id')};
+        END""",
+        'occupancy_batch_delete': """AFTER DELETE ON batches BEGIN
+            DELETE FROM occupancy WHERE batch_id = OLD.id;
+        END""",
+        'occupancy_timeframe_update': f"""AFTER UPDATE OF start_min, end_min ON timeframes BEGIN
+            DELETE FROM occupancy WHERE batch_id IN (SELECT id FROM batches WHERE timeframe_id = NEW.id);
+            {insert} {OCCUPANCY_SELECT.format(condition='b.timeframe_id = NEW.id')};
+        END""",
+    }
+    for name, body in triggers.items():
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+# Full-text indexes behind /api/search: entity -> (indexed columns, label
+# column, detail column). Each is an external-content FTS5 table over the
+# base table, so only the index itself is stored.
+SEARCH_INDEXES = {
+    'teachers': (('name', 'phone'), 'name', 'phone'),
+    'courses': (('name', 'description'), 'name', 'description'),
+    'rooms': (('room_number',), 'room_number', 'capacity'),
+}
+
+def migration_search_indexes(db):
+    """FTS5 indexes for teachers, courses and rooms, kept in sync by triggers"""
+    for table, (columns, _, _) in SEARCH_INDEXES.items():
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f"new.{column}" for column in columns)
+        old_values = ', '.join(f"old.{column}" for column in columns)
+        # Prefix indexes for 1-3 characters keep typeahead lookups on short
+        # input from scanning every term
+        db.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+            {column_list},
+            content='{table}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
         )""")
-        
-        db.commit()
+        db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, {column_list}) VALUES (new.id, {new_values});
+        END""")
+        db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+        END""")
+        db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF {column_list} ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {table}_fts (rowid, {column_list}) VALUES (new.id, {new_values});
+        END""")
+        # One pass over a lookup table; these stay small next to batches
+        db.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+SCHEMA_MIGRATIONS = [
+    (1, "base tables", migration_base_tables),
+    (2, "batch_teachers and batch_days link tables", migration_batch_links),
+    (3, "timeframe minute columns and labels", migration_timeframe_minutes),
+    (4, "room capacity", migration_room_capacity),
+    (5, "change_events feed table", migration_change_events),
+    (6, "occupancy table and triggers", migration_occupancy),
+    (7, "full-text search indexes", migration_search_indexes),
+]
+
+@app.cli.command('migrate')
+@click.option('--to', 'target', type=int, help="Stop at this version instead of the latest.")
+@click.option('--status', is_flag=True, help="Only show the current version and the pending steps.")
+@click.option('--campus', help="Only migrate this campus (default: every campus).")
+def migrate_command(target, status, campus):
+    """Apply pending schema migrations to the configured DATABASE or campus databases."""
+    configure_shards()
+    if campus is not None and campus not in _shards:
+        raise click.BadParameter(f"unknown campus {campus!r}", param_hint='--campus')
+    latest = migrations.latest_version(SCHEMA_MIGRATIONS)
+    for shard in _shards.values():
+        if campus is not None and shard.name != campus:
+            continue
+        with using_shard(shard), app.app_context():
+            db = get_db()
+            click.echo(f"{shard.database}: version {migrations.current_version(db)} of {latest}")
+            if status:
+                for version, description, _ in migrations.pending(db, SCHEMA_MIGRATIONS, target):
+                    click.echo(f"  pending {version}: {description}")
+                continue
+            applied = migrations.migrate(
+                db, SCHEMA_MIGRATIONS, target, log=lambda message, *args: click.echo("  " + message % args)
+            )
+            click.echo(f"applied {len(applied)} migration(s), now at version {migrations.current_version(db)}")
+
+def split_ids(value):
+    """Split a comma-separated id string into a list of ints"""
+    return [int(id) for id in value.split(',') if id.strip()]
+
+def sync_batch_links(db, batch_id, teacher_ids, days):
+    """Rewrite the batch_teachers/batch_days rows for a batch"""
+    db.execute("DELETE FROM batch_teachers WHERE batch_id = ?", (batch_id,))
+    db.execute("DELETE FROM batch_days WHERE batch_id = ?", (batch_id,))
+    db.executemany(
+        "INSERT OR IGNORE INTO batch_teachers (batch_id, teacher_id) VALUES (?, ?)",
+        [(batch_id, int(teacher_id)) for teacher_id in teacher_ids]
+    )
+    db.executemany(
+        "INSERT OR IGNORE INTO batch_days (batch_id, day) VALUES (?, ?)",
+        [(batch_id, day) for day in days]
+    )
+
+def insert_batches(db, rows):
+    """Insert batches with executemany inside the caller's transaction.
+    
+    Each row is (course_id, timeframe_id, room_id, batch_number, days,
+    teacher_ids, active) with days and teacher_ids comma-separated.
+    Returns the new batch ids in row order.
+    """
+    last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM batches").fetchone()[0]
+    db.executemany(
+        """INSERT INTO batches 
+        (course_id, timeframe_id, room_id, batch_number, days, teacher_ids, active) 
+        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        rows
+    )
+    new_ids = {
+        (b['course_id'], b['batch_number']): b['id']
+        for b in db.execute(
+            "SELECT id, course_id, batch_number FROM batches WHERE id > ?", (last_id,)
+        ).fetchall()
+    }
+    ids = [new_ids[(row[0], row[3])] for row in rows]
+    db.executemany(
+        "INSERT OR IGNORE INTO batch_teachers (batch_id, teacher_id) VALUES (?, ?)",
+        [(batch_id, teacher_id) for batch_id, row in zip(ids, rows) for teacher_id in split_ids(row[5])]
+    )
+    db.executemany(
+        "INSERT OR IGNORE INTO batch_days (batch_id, day) VALUES (?, ?)",
+        [(batch_id, day) for batch_id, row in zip(ids, rows) for day in row[4].split(',')]
+    )
+    return ids
+
+def index_batches(ids, rows):
+    """Add committed batch rows, shaped as for insert_batches, to the schedule index"""
+    for batch_id, row in zip(ids, rows):
+        schedule_index.add_batch(batch_id, row[1], split_ids(row[5]), row[4].split(','), row[6], row[2])
+
+# Request instrumentation
+_metrics_exporter = PerProcess(
+    lambda: metrics.export(app.config['METRICS_DIR'], app.config['METRICS_EXPORT_INTERVAL'])
+)
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        if app.config['METRICS_DIR']:
+            _metrics_exporter.get()
+        metrics.start_request(keep_log=app.config['SLOW_REQUEST_MS'] > 0)
 
-init_db()
+@app.after_request
+def record_request_metrics(response):
+    stats = metrics.finish_request()
+    if stats is None:
+        return response
+    
+    elapsed = time_module.perf_counter() - stats.started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.request_seconds.observe(elapsed, endpoint, request.method, str(response.status_code))
+    metrics.sql_statements.inc(stats.statements, endpoint)
+    metrics.sql_seconds.inc(stats.sql_time, endpoint)
+    metrics.sql_vm_steps.inc(stats.vm_steps, endpoint)
+    
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        app.logger.warning(
+            "Slow request %s %s: %.1f ms, %d SQL statements (%.1f ms)%s",
+            request.method, request.full_path.rstrip('?'), elapsed * 1000, stats.statements, stats.sql_time * 1000,
+            ''.join(f"\n  {seconds * 1000:8.2f} ms  {sql}" for seconds, sql in stats.log or ())
+        )
+    return response
+
+@app.before_request
+def ensure_schedule_index():
+    if request.path.startswith('/api/') and request.endpoint not in CAMPUS_FREE_ENDPOINTS:
+        sync_schedule_index()
+
+@app.teardown_request
+def clear_request_metrics(exception):
+    metrics.finish_request()
+
+metrics.REGISTRY.append(metrics.CallbackCounter(
+    'scheduler_conflict_intervals_scanned_total',
+    'Schedule index intervals inspected by overlap queries',
+    lambda: sum(shard.schedule_index.scanned for shard in _shards.values())
+))
+metrics.REGISTRY.append(metrics.CallbackCounter(
+    'scheduler_write_jobs_total', 'Writes run by the writer threads',
+    lambda: sum(shard.writer.jobs for shard in _shards.values())
+))
+metrics.REGISTRY.append(metrics.CallbackCounter(
+    'scheduler_write_commits_total', 'Transactions committed by the writer threads',
+    lambda: sum(shard.writer.groups for shard in _shards.values())
+))
+metrics.REGISTRY.append(metrics.CallbackCounter(
+    'scheduler_snapshot_refreshes_total', 'In-memory read snapshots taken',
+    lambda: sum(shard.snapshot.refreshes for shard in _shards.values() if shard.snapshot)
+))
+metrics.REGISTRY.append(metrics.CallbackCounter(
+    'scheduler_snapshot_reads_total', 'GET requests served from the read snapshot',
+    lambda: sum(shard.snapshot.hits for shard in _shards.values() if shard.snapshot)
+))
+metrics.REGISTRY.append(metrics.CallbackCounter(
+    'scheduler_snapshot_fallbacks_total', 'GET requests sent to the file because the snapshot was too stale',
+    lambda: sum(shard.snapshot.misses for shard in _shards.values() if shard.snapshot)
+))
 
 # Helper functions
+def time_to_minutes(time_str):
+    """Convert a stored time string to minutes since midnight"""
+    time_obj = parse_12h_time(time_str)
+    return time_obj.hour * 60 + time_obj.minute if time_obj else None
+
+def load_schedule_index():
+    """Build the current shard's in-memory conflict index from batches and timeframes"""
+    shard = current_shard()
+    # Read the generation first: a write that lands while the tables are
+    # being read leaves the index marked stale rather than marked current
+    generation = index_generation(shard)
+    with app.app_context():
+        db = get_db()
+        # Changes recorded later are replayed on top; replaying one that
+        # the tables already contain is harmless
+        event_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM change_events").fetchone()[0]
+        timeframes = [
+            (tf['id'], tf['start_min'], tf['end_min'], tf['timeframe'])
+            for tf in db.execute("SELECT id, timeframe, start_min, end_min FROM timeframes").fetchall()
+        ]
+        batches = [
+            (b['id'], b['timeframe_id'], split_ids(b['teacher_ids']), b['days'].split(','), bool(b['active']), b['room_id'])
+            for b in db.execute("SELECT id, timeframe_id, room_id, days, teacher_ids, active FROM batches").fetchall()
+        ]
+        shard.schedule_index.load(timeframes, batches)
+    shard.index_generation = generation
+    shard.index_event_id = event_id
+
+def replay_index_changes(db, shard):
+    """Bring the shard's schedule index up to date from change_events.
+    
+    Runs as a writer job: the write lock keeps other processes from
+    committing meanwhile, and the writer thread is where this process
+    applies its own writes to the index, so nothing interleaves. Every
+    batch and timeframe named by a record since the last replay is re-read
+    by id. Returns False, changing nothing, when a record it needs has been
+    pruned or does not name its rows; the caller then reloads everything.
+    """
+    first = db.execute("SELECT MIN(id) FROM change_events").fetchone()[0]
+    if first is not None and first > shard.index_event_id + 1:
+        return False
+    changed = {'batches': set(), 'timeframes': set()}
+    last_id = shard.index_event_id
+    for row in db.execute(
+        "SELECT id, entity, entity_id, data FROM change_events WHERE id > ? ORDER BY id", (shard.index_event_id,)
+    ).fetchall():
+        last_id = row['id']
+        if row['entity'] not in changed:
+            continue
+        if row['entity_id'] is not None:
+            changed[row['entity']].add(row['entity_id'])
+            continue
+        ids = (json.loads(row['data']) if row['data'] else {}).get('ids')
+        if ids is None:
+            return False
+        changed[row['entity']].update(ids)
+    
+    index = shard.schedule_index
+    # Timeframes first: batches are placed by their timeframe's minutes
+    found = db.execute(
+        "SELECT id, timeframe, start_min, end_min FROM timeframes WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(sorted(changed['timeframes'])),)
+    ).fetchall()
+    for tf in found:
+        index.set_timeframe(tf['id'], tf['start_min'], tf['end_min'], tf['timeframe'])
+    for timeframe_id in changed['timeframes'] - {tf['id'] for tf in found}:
+        index.remove_timeframe(timeframe_id)
+    found = db.execute(
+        "SELECT id, timeframe_id, room_id, days, teacher_ids, active FROM batches "
+        "WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(sorted(changed['batches'])),)
+    ).fetchall()
+    for b in found:
+        index.add_batch(b['id'], b['timeframe_id'], split_ids(b['teacher_ids']), b['days'].split(','),
+                        bool(b['active']), b['room_id'])
+    for batch_id in changed['batches'] - {b['id'] for b in found}:
+        index.remove_batch(batch_id)
+    shard.index_event_id = last_id
+    return True
+
 def parse_12h_time(time_str):
     """Parse 12-hour time string with optional AM/PM into 24-hour time object"""
     if not time_str:
@@ -120,67 +843,281 @@ def validate_time(time_str):
     time_obj = parse_12h_time(time_str)
     return time_obj.strftime('%H:%M') if time_obj else None
 
-def check_schedule_conflict(teacher_ids, days, timeframe_id, exclude_batch_id=None):
-    db = get_db()
+VALID_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def validate_batch_data(data):
+    """Validate a new batch payload, normalizing teacher_ids in place.
+    
+    Returns an error message, or None when the payload is valid.
+    """
+    # Validate required fields
+    required_fields = ['course_id', 'timeframe_id', 'room_id', 'batch_number', 'days', 'teacher_ids']
+    if not isinstance(data, dict) or not all(field in data for field in required_fields):
+        return "Missing required fields"
+    
+    # Convert teacher_ids to list if it's a string
+    if isinstance(data['teacher_ids'], str):
+        data['teacher_ids'] = [int(id.strip()) for id in data['teacher_ids'].split(',') if id.strip()]
+    elif not isinstance(data['teacher_ids'], list):
+        return "teacher_ids must be a list or comma-separated string"
+    
+    # Validate days
+    if not isinstance(data['days'], list):
+        return "days must be a list"
+    if not all(day in VALID_DAYS for day in data['days']):
+        return "Invalid day values"
+    
+    return None
+
+def check_schedule_conflict(teacher_ids, days, timeframe_id, exclude_batch_id=None, all_conflicts=False, db=None):
+    """Find the first teacher/day overlap with one range query on the occupancy table.
+    
+    The query runs on ``db`` (default: the request connection). Writes pass
+    the writer connection, so the check sees exactly what the write
+    transaction is about to commit, whichever worker wrote it. With
+    ``all_conflicts`` the result also lists every overlap under "conflicts".
+    """
+    started = time_module.perf_counter()
     try:
-        # Get the timeframe being checked
+        db = db or get_db()
         timeframe = db.execute(
-            "SELECT start_time, end_time FROM timeframes WHERE id = ?",
-            (timeframe_id,)
+            "SELECT start_min, end_min FROM timeframes WHERE id = ?", (int(timeframe_id),)
         ).fetchone()
         
         if not timeframe:
             return {"error": "Timeframe not found"}
-            
-        new_start = parse_12h_time(timeframe['start_time'])
-        new_end = parse_12h_time(timeframe['end_time'])
         
-        if not new_start or not new_end:
+        if timeframe['start_min'] is None or timeframe['end_min'] is None:
             return {"error": "Invalid timeframe format"}
-            
-        # Check each teacher for each day
-        for teacher_id in teacher_ids:
-            for day in days:
-                # Find conflicting batches
-                query = """
-                    SELECT b.id, t.timeframe, t.start_time, t.end_time 
-                    FROM batches b
-                    JOIN timeframes t ON b.timeframe_id = t.id
-                    WHERE b.days LIKE ? 
-                    AND b.teacher_ids LIKE ?
-                    AND b.active = 1
-                """
-                params = [f'%{day}%', f'%{teacher_id}%']
-                
-                if exclude_batch_id:
-                    query += " AND b.id != ?"
-                    params.append(exclude_batch_id)
-                    
-                batches = db.execute(query, params).fetchall()
-                
-                for batch in batches:
-                    existing_start = parse_12h_time(batch['start_time'])
-                    existing_end = parse_12h_time(batch['end_time'])
-                    
-                    if (existing_start and existing_end and 
-                        new_start < existing_end and 
-                        new_end > existing_start):
-                        return {
-                            "conflict": True,
-                            "teacher_id": teacher_id,
-                            "day": day,
-                            "conflicting_batch": batch['id'],
-                            "timeframe": batch['timeframe']
-                        }
         
-        return {"conflict": False}
+        teacher_ids = [int(teacher_id) for teacher_id in teacher_ids]
+        if not teacher_ids or not days:
+            return {"conflict": False}
+        
+        overlaps = db.execute(f"""
+            SELECT o.teacher_id, o.day, o.start_min, o.batch_id, t.timeframe
+            FROM occupancy o
+            JOIN batches b ON b.id = o.batch_id
+            JOIN timeframes t ON t.id = b.timeframe_id
+            WHERE o.teacher_id IN ({','.join('?' * len(teacher_ids))})
+              AND o.day IN ({','.join('?' * len(days))})
+              AND o.start_min < ? AND o.end_min > ?
+              AND o.batch_id IS NOT ?
+        """, [*teacher_ids, *days, timeframe['end_min'], timeframe['start_min'], exclude_batch_id]).fetchall()
+        
+        if not overlaps:
+            return {"conflict": False}
+        
+        # Report in the order the teachers and days were given, earliest first
+        overlaps.sort(key=lambda row: (
+            teacher_ids.index(row['teacher_id']), list(days).index(row['day']), row['start_min']
+        ))
+        first = overlaps[0]
+        result = {
+            "conflict": True,
+            "teacher_id": first['teacher_id'],
+            "day": first['day'],
+            "conflicting_batch": first['batch_id'],
+            "timeframe": first['timeframe']
+        }
+        if all_conflicts:
+            result["conflicts"] = [
+                {
+                    "teacher_id": row['teacher_id'],
+                    "day": row['day'],
+                    "conflicting_batch": row['batch_id'],
+                    "timeframe": row['timeframe']
+                }
+                for row in overlaps
+            ]
+        return result
     except Exception as e:
         return {"error": str(e)}
     finally:
-        db.close()
+        metrics.conflict_check_seconds.observe(time_module.perf_counter() - started)
+
+EVENTS_MAX_STREAM_SECONDS = float(os.environ.get('EVENTS_MAX_STREAM_SECONDS', 300))
+# Open /api/events streams per worker process. Each holds a worker thread,
+# so the default leaves half of gunicorn's threads for ordinary requests
+EVENTS_MAX_STREAMS = int(os.environ.get(
+    'EVENTS_MAX_STREAMS', max(1, int(os.environ.get('GUNICORN_THREADS', 4)) // 2)
+))
+# Milliseconds a client turned away at the stream limit waits before retrying
+EVENTS_RETRY_MS = int(os.environ.get('EVENTS_RETRY_MS', 15000))
+_event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+class WriteRejected(Exception):
+    """Raised inside a writer job to undo its changes and answer with ``body``"""
+    
+    def __init__(self, body, status=400):
+        super().__init__(body.get('error'))
+        self.body = body
+        self.status = status
+
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+
+# Tables the schedule index is built from
+INDEX_TABLES = ('timeframes', 'batches')
+
+def index_generation(shard):
+    return tuple(shard.generations[GENERATION_TABLES.index(table)] for table in INDEX_TABLES)
+
+def bump_generation(table):
+    shard = current_shard()
+    with shard.generation_lock:
+        before = index_generation(shard)
+        shard.generations[GENERATION_TABLES.index(table)] += 1
+        # The writing process has already applied its change to its own
+        # index, so it stays current unless another process wrote meanwhile
+        if table in INDEX_TABLES and shard.index_generation == before:
+            shard.index_generation = index_generation(shard)
+
+def sync_schedule_index():
+    """Update the schedule index if it was never built or another worker has written since.
+    
+    Other workers' writes are replayed from the change feed; the index is
+    only rebuilt from scratch when the feed no longer reaches back far enough.
+    """
+    shard = current_shard()
+    if shard.schedule_index.loaded and shard.index_generation == index_generation(shard):
+        return
+    with shard.index_reload_lock:
+        if not shard.schedule_index.loaded:
+            load_schedule_index()
+            return
+        generation = index_generation(shard)
+        if shard.index_generation == generation:
+            return
+        # Writes publish their change record before bumping the generation,
+        # so the feed holds every write counted in ``generation``
+        if db_writer.run(replay_index_changes, shard):
+            shard.index_generation = generation
+        else:
+            load_schedule_index()
+
+def publish_change(table, op, id=None, data=None):
+    """Record a committed write for /api/events subscribers.
+    
+    The record is queued and commits with the next write group;
+    subscribers are woken once it has. Returns the writer's Future.
+    """
+    # The callback runs on the writer thread, outside the request
+    feed = current_shard().change_feed
+    
+    def recorded(future):
+        if future.exception() is None:
+            feed.advance(future.result())
+        else:
+            # The write itself has been committed; a lost change record only
+            # leaves live clients slightly behind until their next reload
+            app.logger.warning("Could not record %s %s change: %s", table, op, future.exception())
+    
+    future = db_writer.submit(feed.record, table, op, id, data)
+    future.add_done_callback(recorded)
+    return future
+
+def publish_index_change(table, op, id=None, data=None):
+    """publish_change for INDEX_TABLES, waiting until the record has committed.
+    
+    Other workers replay the schedule index from these records once they
+    see the generation move, so the record must land before the bump.
+    """
+    future = publish_change(table, op, id, data)
+    try:
+        future.result()
+    except Exception:
+        pass  # Logged by publish_change
+
+def write_statement(sql, params=()):
+    """Run one statement through the writer and return its lastrowid"""
+    return db_writer.run(lambda db: db.execute(sql, params).lastrowid)
+
+def generation_etag(tables):
+    """Strong ETag for the current generations of the given tables"""
+    shard = current_shard()
+    # A request reading a snapshot sees the generations the copy was taken at
+    copy = g.get('db_snapshot')
+    generations = copy.version if copy is not None else shard.generations
+    counters = '.'.join(str(generations[GENERATION_TABLES.index(table)]) for table in tables)
+    return f"{shard.etag_prefix}-{counters}"
+
+def tracks_table(table, *dependencies):
+    """Conditional GET and response caching for list endpoints.
+    
+    GET responses get an ETag built from the generations of ``table`` and
+    ``dependencies``; a matching If-None-Match is answered with 304 and
+    unchanged bodies are served from memory without running the query.
+    Successful writes through the wrapped view bump ``table`` and are
+    published to the change feed: the response row for creates and
+    updates, the id for deletes, and a "reload" record when the response
+    does not describe a single row (bulk imports), with the ids of the
+    rows it created.
+    """
+    tables = (table,) + dependencies
+    
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code < 400:
+                    body = response.get_json(silent=True)
+                    publish = publish_index_change if table in INDEX_TABLES else publish_change
+                    if request.method == 'DELETE':
+                        publish(table, 'delete', kwargs.get('id'))
+                    elif isinstance(body, dict) and 'id' in body:
+                        publish(table, 'create' if request.method == 'POST' else 'update', body['id'], body)
+                    else:
+                        results = body.get('results') if isinstance(body, dict) else None
+                        ids = [r['id'] for r in results or () if isinstance(r, dict) and r.get('status') == 'created']
+                        publish(table, 'reload', data={"ids": ids} if results is not None else None)
+                    bump_generation(table)
+                return response
+            
+            if request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+                return view(*args, **kwargs)
+            
+            # The ETag must be taken before the query runs so a concurrent
+            # write can only make the cached entry older, never newer
+            etag = generation_etag(tables)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            
+            key = (current_shard().name, request.path, request.query_string)
+            with _response_cache_lock:
+                cached = _response_cache.get(key)
+                if cached:
+                    _response_cache.move_to_end(key)
+            if cached and cached[0] == etag:
+                _, body, content_type, headers = cached
+                response = Response(body, content_type=content_type, headers=headers)
+                response.set_etag(etag)
+                return response
+            
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                # Non-JSON bodies (calendar feeds) keep their type and file name
+                headers = {
+                    name: value for name, value in response.headers.items()
+                    if name.startswith('X-') or name == 'Content-Disposition'
+                }
+                with _response_cache_lock:
+                    _response_cache[key] = (etag, response.get_data(), response.content_type, headers)
+                    _response_cache.move_to_end(key)
+                    while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                        _response_cache.popitem(last=False)
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
 
 # API Endpoints
 @app.route('/api/teachers', methods=['GET', 'POST'])
+@tracks_table('teachers')
 def teachers():
     db = get_db()
     try:
@@ -191,13 +1128,12 @@ def teachers():
                 return jsonify({"error": "Name and phone are required"}), 400
             
             try:
-                cursor = db.execute(
+                teacher_id = write_statement(
                     "INSERT INTO teachers (name, phone) VALUES (?, ?)",
                     (data['name'].strip(), data['phone'].strip())
                 )
-                db.commit()
                 return jsonify({
-                    "id": cursor.lastrowid,
+                    "id": teacher_id,
                     "name": data['name'],
                     "phone": data['phone']
                 }), 201
@@ -208,22 +1144,18 @@ def teachers():
         return jsonify([dict(t) for t in teachers])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/teachers/<int:id>', methods=['DELETE'])
+@tracks_table('teachers')
 def delete_teacher(id):
-    db = get_db()
     try:
-        db.execute("DELETE FROM teachers WHERE id = ?", (id,))
-        db.commit()
+        write_statement("DELETE FROM teachers WHERE id = ?", (id,))
         return jsonify({"message": "Teacher deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/courses', methods=['GET', 'POST'])
+@tracks_table('courses')
 def courses():
     db = get_db()
     try:
@@ -234,13 +1166,12 @@ def courses():
                 return jsonify({"error": "Course name is required"}), 400
             
             try:
-                cursor = db.execute(
+                course_id = write_statement(
                     "INSERT INTO courses (name, description) VALUES (?, ?)",
                     (data['name'].strip(), data.get('description', '').strip())
                 )
-                db.commit()
                 return jsonify({
-                    "id": cursor.lastrowid,
+                    "id": course_id,
                     "name": data['name'],
                     "description": data.get('description', ''),
                     "active": True
@@ -252,22 +1183,20 @@ def courses():
         return jsonify([dict(c) for c in courses])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/courses/<int:id>', methods=['DELETE'])
+@tracks_table('courses')
 def delete_course(id):
-    db = get_db()
     try:
-        db.execute("DELETE FROM courses WHERE id = ?", (id,))
-        db.commit()
+        write_statement("DELETE FROM courses WHERE id = ?", (id,))
         return jsonify({"message": "Course deleted successfully"}), 200
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "Cannot delete course used in existing batches"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/timeframes', methods=['GET', 'POST'])
+@tracks_table('timeframes')
 def timeframes():
     db = get_db()
     try:
@@ -286,16 +1215,25 @@ def timeframes():
             if start_time >= end_time:
                 return jsonify({"error": "Start time must be before end time"}), 400
             
-            timeframe_str = f"{format_time_12h(start_time)} - {format_time_12h(end_time)}"
+            # Minutes and display labels are computed once here, never on read
+            start_min, end_min = time_to_minutes(start_time), time_to_minutes(end_time)
+            start_label, end_label = format_time_12h(start_time), format_time_12h(end_time)
+            timeframe_str = f"{start_label} - {end_label}"
+            
+            def create(db):
+                timeframe_id = db.execute(
+                    """INSERT INTO timeframes 
+                    (timeframe, start_time, end_time, start_min, end_min, start_label, end_label) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (timeframe_str, start_time, end_time, start_min, end_min, start_label, end_label)
+                ).lastrowid
+                db_writer.after_commit(schedule_index.set_timeframe, timeframe_id, start_min, end_min, timeframe_str)
+                return timeframe_id
             
             try:
-                cursor = db.execute(
-                    "INSERT INTO timeframes (timeframe, start_time, end_time) VALUES (?, ?, ?)",
-                    (timeframe_str, start_time, end_time)
-                )
-                db.commit()
+                timeframe_id = db_writer.run(create)
                 return jsonify({
-                    "id": cursor.lastrowid,
+                    "id": timeframe_id,
                     "timeframe": timeframe_str,
                     "start_time": start_time,
                     "end_time": end_time
@@ -303,25 +1241,20 @@ def timeframes():
             except sqlite3.IntegrityError:
                 return jsonify({"error": "This timeframe already exists"}), 400
         
-        timeframes = db.execute("SELECT id, timeframe, start_time, end_time FROM timeframes ORDER BY start_time").fetchall()
-        
-        # Format times for display
-        formatted_timeframes = []
-        for tf in timeframes:
-            tf_dict = dict(tf)
-            tf_dict['display_timeframe'] = f"{format_time_12h(tf['start_time'])} - {format_time_12h(tf['end_time'])}"
-            formatted_timeframes.append(tf_dict)
-            
-        return jsonify(formatted_timeframes)
+        timeframes = db.execute("""
+            SELECT id, timeframe, start_time, end_time,
+                   start_label || ' - ' || end_label AS display_timeframe
+            FROM timeframes
+            ORDER BY start_min
+        """).fetchall()
+        return jsonify([dict(tf) for tf in timeframes])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/timeframes/<int:id>', methods=['DELETE'])
+@tracks_table('timeframes')
 def delete_timeframe(id):
-    db = get_db()
-    try:
+    def delete(db):
         # Check if timeframe is used in any batches
         batches = db.execute(
             "SELECT COUNT(*) as count FROM batches WHERE timeframe_id = ?",
@@ -329,17 +1262,21 @@ def delete_timeframe(id):
         ).fetchone()
         
         if batches['count'] > 0:
-            return jsonify({"error": "Cannot delete timeframe used in existing batches"}), 400
+            raise WriteRejected({"error": "Cannot delete timeframe used in existing batches"})
             
         db.execute("DELETE FROM timeframes WHERE id = ?", (id,))
-        db.commit()
+        db_writer.after_commit(schedule_index.remove_timeframe, id)
+    
+    try:
+        db_writer.run(delete)
         return jsonify({"message": "Timeframe deleted successfully"}), 200
+    except WriteRejected as e:
+        return jsonify(e.body), e.status
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/rooms', methods=['GET', 'POST'])
+@tracks_table('rooms')
 def rooms():
     db = get_db()
     try:
@@ -349,30 +1286,32 @@ def rooms():
             if not data or not data.get('room_number'):
                 return jsonify({"error": "Room number is required"}), 400
             
+            capacity = data.get('capacity')
+            if capacity is not None and (not isinstance(capacity, int) or capacity <= 0):
+                return jsonify({"error": "Capacity must be a positive integer"}), 400
+            
             try:
-                cursor = db.execute(
-                    "INSERT INTO rooms (room_number) VALUES (?)",
-                    (data['room_number'].strip(),)
+                room_id = write_statement(
+                    "INSERT INTO rooms (room_number, capacity) VALUES (?, ?)",
+                    (data['room_number'].strip(), capacity)
                 )
-                db.commit()
                 return jsonify({
-                    "id": cursor.lastrowid,
-                    "room_number": data['room_number']
+                    "id": room_id,
+                    "room_number": data['room_number'],
+                    "capacity": capacity
                 }), 201
             except sqlite3.IntegrityError:
                 return jsonify({"error": "Room with this number already exists"}), 400
         
-        rooms = db.execute("SELECT id, room_number FROM rooms ORDER BY room_number").fetchall()
+        rooms = db.execute("SELECT id, room_number, capacity FROM rooms ORDER BY room_number").fetchall()
         return jsonify([dict(r) for r in rooms])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/rooms/<int:id>', methods=['DELETE'])
+@tracks_table('rooms')
 def delete_room(id):
-    db = get_db()
-    try:
+    def delete(db):
         # Check if room is used in any batches
         batches = db.execute(
             "SELECT COUNT(*) as count FROM batches WHERE room_id = ?",
@@ -380,58 +1319,318 @@ def delete_room(id):
         ).fetchone()
         
         if batches['count'] > 0:
-            return jsonify({"error": "Cannot delete room used in existing batches"}), 400
+            raise WriteRejected({"error": "Cannot delete room used in existing batches"})
             
         db.execute("DELETE FROM rooms WHERE id = ?", (id,))
-        db.commit()
+    
+    try:
+        db_writer.run(delete)
         return jsonify({"message": "Room deleted successfully"}), 200
+    except WriteRejected as e:
+        return jsonify(e.body), e.status
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
+
+# Rows read per type and match query; broader queries rank their oldest
+# SEARCH_CANDIDATES label-prefix and general matches, so short prefixes stay
+# as fast as long ones without losing labels that start with the query
+SEARCH_CANDIDATES = int(os.environ.get('SEARCH_CANDIDATES', 200))
+
+def fold(text):
+    """Lowercase ``text`` without accents, the way the FTS5 tokenizer sees it"""
+    return ''.join(c for c in unicodedata.normalize('NFKD', str(text).lower()) if not unicodedata.combining(c))
+
+def search_words(text):
+    return re.findall(r'\w+', fold(text))[:8]
+
+def search_rank(words, label):
+    """Sort key for a match: labels starting with the query first, then
+    labels containing every query word as a word prefix, then matches on
+    other columns only; fewer and shorter words first within each group"""
+    label_words = search_words(label)
+    if ' '.join(label_words).startswith(' '.join(words)):
+        group = 0
+    elif all(any(label_word.startswith(word) for label_word in label_words) for word in words):
+        group = 1
+    else:
+        group = 2
+    return (group, len(label_words), len(str(label)))
+
+@app.route('/api/search', methods=['GET'])
+@tracks_table('teachers', 'courses', 'rooms')
+def search():
+    """Typeahead over teachers, courses and rooms.
+    
+    Query parameters: q, types (comma-separated subset of teachers, courses
+    and rooms; default all), limit (default 10, at most 50) and active
+    (1 leaves out inactive courses). Every word of q matches as a prefix of
+    a word in any indexed column; results of all types are ranked together
+    by search_rank. Labels starting with the query are always considered;
+    beyond those, queries matching more than SEARCH_CANDIDATES rows of a type
+    only rank the first of them.
+    """
+    words = search_words(request.args.get('q', ''))
+    types = [t.strip() for t in request.args.get('types', ','.join(SEARCH_INDEXES)).split(',') if t.strip()]
+    limit = request.args.get('limit', 10, type=int)
+    active_only = request.args.get('active') == '1'
+    if not all(t in SEARCH_INDEXES for t in types):
+        return jsonify({"error": f"types must be a subset of {', '.join(SEARCH_INDEXES)}"}), 400
+    if not 0 < limit <= 50:
+        return jsonify({"error": "limit must be between 1 and 50"}), 400
+    if not words:
+        return jsonify({"results": []})
+    
+    db = get_db()
+    try:
+        results = []
+        for table in types:
+            results.extend(search_matches(db, table, words, active_only))
+        results.sort(key=lambda result: result[0])
+        return jsonify({"results": [result for _, result in results[:limit]]})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Searchable tables whose rows can be deactivated
+SEARCH_ACTIVE_TABLES = {'courses'}
+
+def search_matches(db, table, words, active_only=False):
+    """(search_rank, result) pairs for rows of ``table`` matching ``words``
+
+    When more than SEARCH_CANDIDATES rows match, labels starting with the
+    query are looked up as well, so the limit cannot cut the best-ranked rows.
+    """
+    _, label, detail = SEARCH_INDEXES[table]
+    active = "AND b.active = 1" if active_only and table in SEARCH_ACTIVE_TABLES else ""
+    queries = [' '.join(f'"{word}"*' for word in words)]
+    rows = {}
+    while queries:
+        # Without ORDER BY, FTS5 stops reading after the first
+        # SEARCH_CANDIDATES matches instead of visiting every one
+        matched = db.execute(f"""
+            SELECT b.id, b.{label}, b.{detail}
+            FROM {table}_fts
+            JOIN {table} b ON b.id = {table}_fts.rowid
+            WHERE {table}_fts MATCH ? {active}
+            LIMIT ?
+        """, (queries.pop(0), SEARCH_CANDIDATES)).fetchall()
+        if len(matched) == SEARCH_CANDIDATES and not rows:
+            # Labels starting with the query words, then with the query
+            phrase = ' + '.join(f'"{word}"' for word in words)
+            queries += [f'{label} : ^ {phrase}', f'{label} : ^ {phrase}*']
+        for row in matched:
+            rows.setdefault(row[0], row)
+    return [
+        (search_rank(words, row[1]), {"entity": table, "id": row[0], "label": row[1], "detail": row[2]})
+        for row in rows.values()
+    ]
+
+# Cross-campus queries run on one thread pool per worker process, one task
+# per campus database, so a lookup costs about as long as the slowest campus
+_fanout_pool = PerProcess(
+    lambda: ThreadPoolExecutor(app.config['CAMPUS_FANOUT_THREADS'], thread_name_prefix='campus-fanout')
+)
+
+def run_on_shard(shard, job, *args):
+    """Run ``job(db, *args)`` with ``shard`` current and one of its pooled connections"""
+    with using_shard(shard), app.app_context():
+        return job(get_db(), *args)
+
+def fan_out(shards, job, *args):
+    """Run ``job(db, *args)`` on every shard at once.
+    
+    Returns {campus: result}; campuses whose job raised map to the exception.
+    """
+    futures = {shard.name: _fanout_pool.get().submit(run_on_shard, shard, job, *args) for shard in shards}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            results[name] = e
+    return results
+
+@app.route('/api/campuses', methods=['GET'])
+def list_campuses():
+    """Configured campuses; empty in single-database mode"""
+    return jsonify({"campuses": list(app.config['CAMPUSES']), "default": app.config['DEFAULT_CAMPUS']})
+
+def lookup_teachers(db, words, limit):
+    """The best ``limit`` teacher matches on one campus, with their active batch counts"""
+    matches = sorted(search_matches(db, 'teachers', words), key=lambda match: match[0])[:limit]
+    ids = [result['id'] for _, result in matches]
+    counts = dict(db.execute(f"""
+        SELECT bt.teacher_id, COUNT(*)
+        FROM batch_teachers bt
+        JOIN batches b ON b.id = bt.batch_id
+        WHERE b.active = 1 AND bt.teacher_id IN ({','.join('?' * len(ids))})
+        GROUP BY bt.teacher_id
+    """, ids).fetchall()) if ids else {}
+    return [
+        (rank, {"id": result['id'], "name": result['label'], "phone": result['detail'],
+                "active_batches": counts.get(result['id'], 0)})
+        for rank, result in matches
+    ]
+
+@app.route('/api/campuses/teachers', methods=['GET'])
+def campus_teacher_lookup():
+    """Find teachers on every campus at once.
+    
+    Query parameters: q (matched like /api/search), campuses
+    (comma-separated; default all) and limit (default 20, at most 100).
+    Each campus database is searched on its own fan-out thread; matches
+    are ranked together and carry their campus. A campus that cannot be
+    searched is reported under "errors" rather than failing the lookup.
+    """
+    words = search_words(request.args.get('q', ''))
+    limit = request.args.get('limit', 20, type=int)
+    names = [name.strip() for name in request.args.get('campuses', '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in _shards]
+    if unknown:
+        return jsonify({"error": f"Unknown campus: {', '.join(unknown)}"}), 404
+    if not 0 < limit <= 100:
+        return jsonify({"error": "limit must be between 1 and 100"}), 400
+    if not words:
+        return jsonify({"results": [], "errors": {}})
+    
+    shards = [_shards[name] for name in names] if names else list(_shards.values())
+    results, errors = [], {}
+    for name, found in fan_out(shards, lookup_teachers, words, limit).items():
+        if isinstance(found, Exception):
+            app.logger.warning("Teacher lookup failed on campus %s: %s", name, found)
+            errors[name] = str(found)
+            continue
+        results.extend((rank, dict(teacher, campus=name)) for rank, teacher in found)
+    results.sort(key=lambda result: result[0])
+    return jsonify({"results": [result for _, result in results[:limit]], "errors": errors})
+
+def encode_cursor(course, batch_number, batch_id):
+    """Opaque keyset cursor for the (course name, batch_number, id) ordering"""
+    return base64.urlsafe_b64encode(json.dumps([course, batch_number, batch_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        course, batch_number, batch_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return [course, batch_number, int(batch_id)]
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def batch_filters(args):
+    """Build WHERE clauses for the GET /api/batches filters"""
+    where, params = [], []
+    for field in ('course_id', 'room_id'):
+        if args.get(field):
+            where.append(f"b.{field} = ?")
+            params.append(int(args[field]))
+    if args.get('teacher_id'):
+        where.append("b.id IN (SELECT batch_id FROM batch_teachers WHERE teacher_id = ?)")
+        params.append(int(args['teacher_id']))
+    if args.get('day'):
+        if args['day'] not in VALID_DAYS:
+            raise ValueError("Invalid day value")
+        where.append("b.id IN (SELECT batch_id FROM batch_days WHERE day = ?)")
+        params.append(args['day'])
+    if args.get('active') is not None:
+        where.append("b.active = ?")
+        params.append(1 if args['active'].lower() in ('1', 'true', 'yes') else 0)
+    return where, params
+
+# Response object of one batch, built by SQLite: teacher names are
+# resolved per batch in teacher_ids order, so no Python-side lookup table
+BATCH_JSON = """
+    json_object(
+        'id', b.id,
+        'course_id', b.course_id,
+        'course', c.name,
+        'timeframe_id', b.timeframe_id,
+        'timeframe', t.timeframe,
+        'room_id', b.room_id,
+        'room', r.room_number,
+        'batch_number', b.batch_number,
+        'days', json('["' || replace(b.days, ',', '","') || '"]'),
+        'teacher_ids', json('[' || b.teacher_ids || ']'),
+        'teacher_names', (
+            SELECT json_group_array(COALESCE(tt.name, 'Teacher ' || j.value))
+            FROM json_each('[' || b.teacher_ids || ']') j
+            LEFT JOIN teachers tt ON tt.id = j.value
+        ),
+        'active', json(CASE WHEN b.active THEN 'true' ELSE 'false' END)
+    )
+"""
+
+BATCH_FROM = """
+    FROM batches b
+    JOIN courses c ON b.course_id = c.id
+    JOIN timeframes t ON b.timeframe_id = t.id
+    JOIN rooms r ON b.room_id = r.id
+"""
+
+def iter_batch_json(db, where=(), params=(), limit=None, chunk_size=500):
+    """Yield (course, batch_number, id, batch JSON text) in (course name, batch_number, id) order.
+    
+    Rows are read from the cursor in chunks, so memory stays flat
+    regardless of the table size.
+    """
+    query = f"SELECT c.name, b.batch_number, b.id, {BATCH_JSON} {BATCH_FROM}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY c.name, b.batch_number, b.id"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    
+    cursor = db.execute(query, list(params))
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        yield from (tuple(row) for row in chunk)
+
+def iter_batches(db, where=(), params=(), limit=None):
+    """Like iter_batch_json, but yields the batches as dicts"""
+    for _, _, _, batch in iter_batch_json(db, where, params, limit):
+        yield json.loads(batch)
+
+def batch_response(db, batch_id, status=200):
+    """JSON response with a single batch, serialized by SQLite"""
+    row = db.execute(f"SELECT {BATCH_JSON} {BATCH_FROM} WHERE b.id = ?", (batch_id,)).fetchone()
+    if row is None:
+        return jsonify({"error": "Batch not found"}), 404
+    return Response(row[0], status=status, mimetype='application/json')
 
 @app.route('/api/batches', methods=['GET', 'POST'])
+@tracks_table('batches', 'courses', 'timeframes', 'rooms', 'teachers')
 def batches():
     db = get_db()
     try:
         if request.method == 'POST':
             data = request.get_json()
             
-            # Validate required fields
-            required_fields = ['course_id', 'timeframe_id', 'room_id', 'batch_number', 'days', 'teacher_ids']
-            if not all(field in data for field in required_fields):
-                return jsonify({"error": "Missing required fields"}), 400
-            
-            # Convert teacher_ids to list if it's a string
-            if isinstance(data['teacher_ids'], str):
-                data['teacher_ids'] = [int(id.strip()) for id in data['teacher_ids'].split(',') if id.strip()]
-            elif not isinstance(data['teacher_ids'], list):
-                return jsonify({"error": "teacher_ids must be a list or comma-separated string"}), 400
-            
-            # Validate days
-            if not isinstance(data['days'], list):
-                return jsonify({"error": "days must be a list"}), 400
-            valid_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-            if not all(day in valid_days for day in data['days']):
-                return jsonify({"error": "Invalid day values"}), 400
-            
-            # Check for schedule conflicts
-            conflict_check = check_schedule_conflict(
-                data['teacher_ids'],
-                data['days'],
-                data['timeframe_id']
-            )
+            error = validate_batch_data(data)
+            if error:
+                return jsonify({"error": error}), 400
             
-            if 'error' in conflict_check:
-                return jsonify({"error": conflict_check['error']}), 400
-            elif conflict_check.get('conflict'):
-                return jsonify({
-                    "error": "Schedule conflict",
-                    "details": conflict_check
-                }), 409
+            all_conflicts = request.args.get('conflicts') == 'all'
             
-            # Insert new batch
-            try:
+            def create(db):
+                # Check for schedule conflicts; ?conflicts=all reports every
+                # overlap. Check and insert share the write transaction, so
+                # no other write can slip in between them.
+                conflict_check = check_schedule_conflict(
+                    data['teacher_ids'],
+                    data['days'],
+                    data['timeframe_id'],
+                    all_conflicts=all_conflicts,
+                    db=db
+                )
+                
+                if 'error' in conflict_check:
+                    raise WriteRejected({"error": conflict_check['error']})
+                elif conflict_check.get('conflict'):
+                    raise WriteRejected({
+                        "error": "Schedule conflict",
+                        "details": conflict_check
+                    }, 409)
+                
+                # Insert new batch
                 cursor = db.execute(
                     """INSERT INTO batches 
                     (course_id, timeframe_id, room_id, batch_number, days, teacher_ids, active) 
@@ -446,39 +1645,24 @@ def batches():
                         data.get('active', True)
                     )
                 )
-                db.commit()
-                
-                # Get the full batch data to return
-                batch = db.execute("""
-                    SELECT b.id, b.course_id, c.name AS course, b.timeframe_id, 
-                           t.timeframe, b.room_id, r.room_number, 
-                           b.batch_number, b.days, b.teacher_ids, b.active
-                    FROM batches b
-                    JOIN courses c ON b.course_id = c.id
-                    JOIN timeframes t ON b.timeframe_id = t.id
-                    JOIN rooms r ON b.room_id = r.id
-                    WHERE b.id = ?
-                """, (cursor.lastrowid,)).fetchone()
-                
-                # Get teacher names
-                teachers = {t['id']: t['name'] for t in db.execute("SELECT id, name FROM teachers").fetchall()}
-                teacher_ids = [int(id) for id in batch['teacher_ids'].split(',') if id.strip()]
-                teacher_names = [teachers.get(id, f"Teacher {id}") for id in teacher_ids]
+                sync_batch_links(db, cursor.lastrowid, data['teacher_ids'], data['days'])
+                db_writer.after_commit(
+                    schedule_index.add_batch,
+                    cursor.lastrowid,
+                    data['timeframe_id'],
+                    data['teacher_ids'],
+                    data['days'],
+                    bool(data.get('active', True)),
+                    data['room_id']
+                )
+                return cursor.lastrowid
+            
+            try:
+                batch_id = db_writer.run(create)
                 
-                return jsonify({
-                    "id": batch['id'],
-                    "course_id": batch['course_id'],
-                    "course": batch['course'],
-                    "timeframe_id": batch['timeframe_id'],
-                    "timeframe": batch['timeframe'],
-                    "room_id": batch['room_id'],
-                    "room": batch['room_number'],
-                    "batch_number": batch['batch_number'],
-                    "days": batch['days'].split(','),
-                    "teacher_ids": teacher_ids,
-                    "teacher_names": teacher_names,
-                    "active": bool(batch['active'])
-                }), 201
+                return batch_response(db, batch_id, 201)
+            except WriteRejected as e:
+                return jsonify(e.body), e.status
             except sqlite3.IntegrityError as e:
                 if "FOREIGN KEY" in str(e):
                     return jsonify({"error": "Invalid course, timeframe, or room ID"}), 400
@@ -486,167 +1670,1056 @@ def batches():
                     return jsonify({"error": "Batch with this number already exists for this course"}), 400
                 return jsonify({"error": str(e)}), 400
         
-        # GET all batches with expanded information
-        batches = db.execute("""
-            SELECT b.id, b.course_id, c.name AS course, b.timeframe_id, 
-                   t.timeframe, b.room_id, r.room_number, 
-                   b.batch_number, b.days, b.teacher_ids, b.active
-            FROM batches b
-            JOIN courses c ON b.course_id = c.id
-            JOIN timeframes t ON b.timeframe_id = t.id
-            JOIN rooms r ON b.room_id = r.id
-            ORDER BY c.name, b.batch_number
-        """).fetchall()
+        # GET batches with expanded information, optionally filtered and paged
+        try:
+            where, params = batch_filters(request.args)
+            limit = request.args.get('limit')
+            if limit is not None:
+                try:
+                    limit = int(limit)
+                except ValueError:
+                    limit = 0
+                if limit <= 0:
+                    raise ValueError("limit must be a positive integer")
+            cursor = request.args.get('cursor')
+            if cursor:
+                where.append("(c.name, b.batch_number, b.id) > (?, ?, ?)")
+                params.extend(decode_cursor(cursor))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Get teacher names
-        teachers = {t['id']: t['name'] for t in db.execute("SELECT id, name FROM teachers").fetchall()}
+        rows = iter_batch_json(db, where, params, limit)
         
-        formatted_batches = []
-        for batch in batches:
-            teacher_ids = [int(id) for id in batch['teacher_ids'].split(',') if id.strip()]
-            teacher_names = [teachers.get(id, f"Teacher {id}") for id in teacher_ids]
-            
-            formatted_batches.append({
-                "id": batch['id'],
-                "course_id": batch['course_id'],
-                "course": batch['course'],
-                "timeframe_id": batch['timeframe_id'],
-                "timeframe": batch['timeframe'],
-                "room_id": batch['room_id'],
-                "room": batch['room_number'],
-                "batch_number": batch['batch_number'],
-                "days": batch['days'].split(','),
-                "teacher_ids": teacher_ids,
-                "teacher_names": teacher_names,
-                "active": bool(batch['active'])
-            })
+        if request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+            return Response(
+                stream_with_context(batch + '\n' for _, _, _, batch in rows),
+                mimetype='application/x-ndjson'
+            )
         
-        return jsonify(formatted_batches)
+        # The rows are already JSON; splice them into the array unparsed
+        rows = list(rows)
+        response = Response('[' + ','.join(batch for _, _, _, batch in rows) + ']', mimetype='application/json')
+        if limit is not None and len(rows) == limit:
+            response.headers['X-Next-Cursor'] = encode_cursor(*rows[-1][:3])
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def existing_conflicts(db, candidates):
+    """First teacher/day overlap with the committed schedule for each candidate row.
+    
+    ``candidates`` maps row_number to (teacher_ids, days, timeframe_id).
+    All rows are checked with one query that joins them, unpacked from
+    JSON, to the occupancy table on ``db``; the result maps the row_number
+    of every conflicting row to a check_schedule_conflict-style result.
+    """
+    started = time_module.perf_counter()
+    wanted = [
+        [row_number, teacher_id, day, timeframe_id]
+        for row_number, (teacher_ids, days, timeframe_id) in candidates.items()
+        for teacher_id in teacher_ids
+        for day in days
+    ]
+    if not wanted:
+        return {}
+    overlaps = db.execute("""
+        WITH wanted(row_number, teacher_id, day, timeframe_id) AS (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'),
+                   json_extract(value, '$[2]'), json_extract(value, '$[3]')
+            FROM json_each(?)
+        )
+        SELECT w.row_number, o.teacher_id, o.day, o.start_min, o.batch_id, ot.timeframe
+        FROM wanted w
+        JOIN timeframes t ON t.id = w.timeframe_id
+        JOIN occupancy o ON o.teacher_id = w.teacher_id AND o.day = w.day
+            AND o.start_min < t.end_min AND o.end_min > t.start_min
+        JOIN batches b ON b.id = o.batch_id
+        JOIN timeframes ot ON ot.id = b.timeframe_id
+    """, (json.dumps(wanted),)).fetchall()
+    metrics.conflict_check_seconds.observe(time_module.perf_counter() - started)
+    
+    # Report in the order the teachers and days were given, earliest first
+    first = {}
+    for row in overlaps:
+        teacher_ids, days, _ = candidates[row['row_number']]
+        key = (teacher_ids.index(row['teacher_id']), days.index(row['day']), row['start_min'])
+        if row['row_number'] not in first or key < first[row['row_number']][0]:
+            first[row['row_number']] = (key, row)
+    return {
+        row_number: {
+            "conflict": True,
+            "teacher_id": row['teacher_id'],
+            "day": row['day'],
+            "conflicting_batch": row['batch_id'],
+            "timeframe": row['timeframe']
+        }
+        for row_number, (_, row) in first.items()
+    }
+
+def create_batches(db, rows):
+    """Validate new batches and insert the valid ones in the caller's write transaction.
+    
+    ``rows`` yields (row_number, payload) pairs shaped like a POST
+    /api/batches body. Every row is checked against the existing schedule
+    in one query and against the rows before it in memory; accepted rows
+    are inserted together. Returns the per-row results and (batch_id,
+    values) for every created batch, values shaped as for insert_batches.
+    """
+    course_ids = {c['id'] for c in db.execute("SELECT id FROM courses").fetchall()}
+    room_ids = {r['id'] for r in db.execute("SELECT id FROM rooms").fetchall()}
+    batch_numbers = {
+        (b['course_id'], b['batch_number'])
+        for b in db.execute("SELECT course_id, batch_number FROM batches").fetchall()
+    }
+    
+    results = []
+    valid = []
+    for row_number, data in rows:
+        result = {"row": row_number}
+        results.append(result)
+        try:
+            error = validate_batch_data(data)
+            if not error:
+                course_id, timeframe_id, room_id = int(data['course_id']), int(data['timeframe_id']), int(data['room_id'])
+                batch_number = str(data['batch_number']).strip()
+                teacher_ids = [int(teacher_id) for teacher_id in data['teacher_ids']]
+                if (course_id not in course_ids or room_id not in room_ids
+                        or timeframe_id not in schedule_index.timeframes):
+                    error = "Invalid course, timeframe, or room ID"
+                elif schedule_index.timeframes[timeframe_id][0] is None:
+                    error = "Invalid timeframe format"
+        except (TypeError, ValueError):
+            error = "Invalid batch values"
+        
+        if error:
+            result.update(status="error", error=error)
+            continue
+        valid.append((result, row_number, data, course_id, timeframe_id, room_id, batch_number, teacher_ids))
+    
+    conflicts = existing_conflicts(db, {
+        row_number: (teacher_ids, data['days'], timeframe_id)
+        for _, row_number, data, _, timeframe_id, _, _, teacher_ids in valid
+        if data.get('active', True)
+    })
+    
+    # Accepted rows are indexed under negative ids so later rows in the
+    # same request are checked against them as well
+    pending = ScheduleIndex()
+    pending.timeframes = schedule_index.timeframes
+    
+    accepted = []
+    for result, row_number, data, course_id, timeframe_id, room_id, batch_number, teacher_ids in valid:
+        if (course_id, batch_number) in batch_numbers:
+            result.update(status="error", error="Batch with this number already exists for this course")
+            continue
+        
+        active = bool(data.get('active', True))
+        if active:
+            conflict_check = conflicts.get(row_number, {"conflict": False})
+            if not conflict_check['conflict']:
+                start, end, _ = schedule_index.timeframes[timeframe_id]
+                for teacher_id in teacher_ids:
+                    for day in data['days']:
+                        overlaps = pending.overlapping(teacher_id, day, start, end)
+                        if overlaps:
+                            conflict_check = {
+                                "conflict": True,
+                                "teacher_id": teacher_id,
+                                "day": day,
+                                "conflicting_row": -overlaps[0][2] - 1
+                            }
+                            break
+                    if conflict_check['conflict']:
+                        break
+            if conflict_check['conflict']:
+                result.update(status="conflict", error="Schedule conflict", details=conflict_check)
+                continue
+            pending.add_batch(-row_number - 1, timeframe_id, teacher_ids, data['days'])
+        
+        batch_numbers.add((course_id, batch_number))
+        accepted.append((result, (
+            course_id, timeframe_id, room_id, batch_number,
+            ','.join(data['days']), ','.join(map(str, teacher_ids)), active
+        )))
+    
+    new_ids = insert_batches(db, [values for _, values in accepted]) if accepted else []
+    db_writer.after_commit(index_batches, new_ids, [values for _, values in accepted])
+    created = []
+    for (result, values), batch_id in zip(accepted, new_ids):
+        result.update(status="created", id=batch_id)
+        created.append((batch_id, values))
+    return results, created
+
+@app.route('/api/batches/bulk', methods=['POST'])
+@tracks_table('batches')
+def bulk_create_batches():
+    """Create many batches at once from a JSON list or an NDJSON stream.
+    
+    Every row is validated in a single pass against the existing schedule
+    and against the rows before it; valid rows are inserted in one
+    transaction and the response reports the outcome of each row.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            rows = [json.loads(line) for line in request.stream if line.strip()]
+        except ValueError:
+            return jsonify({"error": "Invalid NDJSON body"}), 400
+    else:
+        rows = request.get_json(silent=True)
+        if isinstance(rows, dict):
+            rows = rows.get('batches')
+        if not isinstance(rows, list):
+            return jsonify({"error": "Expected a list of batches"}), 400
+    
+    try:
+        # Validation reads and the insert share the write transaction, so
+        # the checks still hold when the rows are committed
+        results, created = db_writer.run(create_batches, list(enumerate(rows)))
+        
+        return jsonify({
+            "created": len(created),
+            "failed": len(results) - len(created),
+            "results": results
+        }), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/batches/<int:id>', methods=['PUT', 'DELETE'])
+@tracks_table('batches')
 def manage_batch(id):
     db = get_db()
     try:
         if request.method == 'PUT':
             data = request.get_json()
+            all_conflicts = request.args.get('conflicts') == 'all'
             
-            # Get current batch data
-            current_batch = db.execute(
-                "SELECT * FROM batches WHERE id = ?", 
-                (id,)
-            ).fetchone()
-            
-            if not current_batch:
-                return jsonify({"error": "Batch not found"}), 404
+            def update(db):
+                # Get current batch data
+                current_batch = db.execute(
+                    "SELECT * FROM batches WHERE id = ?", 
+                    (id,)
+                ).fetchone()
                 
-            # Prepare update data with defaults from current batch if not provided
-            update_data = {
-                'course_id': data.get('course_id', current_batch['course_id']),
-                'timeframe_id': data.get('timeframe_id', current_batch['timeframe_id']),
-                'room_id': data.get('room_id', current_batch['room_id']),
-                'batch_number': data.get('batch_number', current_batch['batch_number']),
-                'days': data.get('days', current_batch['days'].split(',')),
-                'teacher_ids': data.get('teacher_ids', [int(id) for id in current_batch['teacher_ids'].split(',') if id.strip()]),
-                'active': data.get('active', current_batch['active'])
-            }
-            
-            # Convert teacher_ids if it's a string
-            if isinstance(update_data['teacher_ids'], str):
-                update_data['teacher_ids'] = [int(id.strip()) for id in update_data['teacher_ids'].split(',') if id.strip()]
-            
-            # Validate days
-            valid_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-            if not all(day in valid_days for day in update_data['days']):
-                return jsonify({"error": "Invalid day values"}), 400
-            
-            # Check for schedule conflicts if timeframe, teachers, or days changed
-            if ('timeframe_id' in data or 'teacher_ids' in data or 'days' in data):
-                conflict_check = check_schedule_conflict(
+                if not current_batch:
+                    raise WriteRejected({"error": "Batch not found"}, 404)
+                    
+                # Prepare update data with defaults from current batch if not provided
+                update_data = {
+                    'course_id': data.get('course_id', current_batch['course_id']),
+                    'timeframe_id': data.get('timeframe_id', current_batch['timeframe_id']),
+                    'room_id': data.get('room_id', current_batch['room_id']),
+                    'batch_number': data.get('batch_number', current_batch['batch_number']),
+                    'days': data.get('days', current_batch['days'].split(',')),
+                    'teacher_ids': data.get('teacher_ids', split_ids(current_batch['teacher_ids'])),
+                    'active': data.get('active', current_batch['active'])
+                }
+                
+                # Convert teacher_ids if it's a string
+                if isinstance(update_data['teacher_ids'], str):
+                    update_data['teacher_ids'] = [int(id.strip()) for id in update_data['teacher_ids'].split(',') if id.strip()]
+                
+                # Validate days
+                if not all(day in VALID_DAYS for day in update_data['days']):
+                    raise WriteRejected({"error": "Invalid day values"})
+                
+                # Check for schedule conflicts if timeframe, teachers, or days changed
+                if ('timeframe_id' in data or 'teacher_ids' in data or 'days' in data):
+                    conflict_check = check_schedule_conflict(
+                        update_data['teacher_ids'],
+                        update_data['days'],
+                        update_data['timeframe_id'],
+                        id,
+                        all_conflicts=all_conflicts,
+                        db=db
+                    )
+                    
+                    if 'error' in conflict_check:
+                        raise WriteRejected({"error": conflict_check['error']})
+                    elif conflict_check.get('conflict'):
+                        raise WriteRejected({
+                            "error": "Schedule conflict",
+                            "details": conflict_check
+                        }, 409)
+                
+                # Perform update
+                db.execute("""
+                    UPDATE batches SET
+                        course_id = ?,
+                        timeframe_id = ?,
+                        room_id = ?,
+                        batch_number = ?,
+                        days = ?,
+                        teacher_ids = ?,
+                        active = ?
+                    WHERE id = ?
+                """, (
+                    int(update_data['course_id']),
+                    int(update_data['timeframe_id']),
+                    int(update_data['room_id']),
+                    update_data['batch_number'].strip(),
+                    ','.join(update_data['days']),
+                    ','.join(map(str, update_data['teacher_ids'])),
+                    update_data['active'],
+                    id
+                ))
+                sync_batch_links(db, id, update_data['teacher_ids'], update_data['days'])
+                db_writer.after_commit(
+                    schedule_index.add_batch,
+                    id,
+                    update_data['timeframe_id'],
                     update_data['teacher_ids'],
                     update_data['days'],
-                    update_data['timeframe_id'],
-                    id
+                    bool(update_data['active']),
+                    update_data['room_id']
                 )
-                
-                if 'error' in conflict_check:
-                    return jsonify({"error": conflict_check['error']}), 400
-                elif conflict_check.get('conflict'):
-                    return jsonify({
-                        "error": "Schedule conflict",
-                        "details": conflict_check
-                    }), 409
-            
-            # Perform update
-            db.execute("""
-                UPDATE batches SET
-                    course_id = ?,
-                    timeframe_id = ?,
-                    room_id = ?,
-                    batch_number = ?,
-                    days = ?,
-                    teacher_ids = ?,
-                    active = ?
-                WHERE id = ?
-            """, (
-                int(update_data['course_id']),
-                int(update_data['timeframe_id']),
-                int(update_data['room_id']),
-                update_data['batch_number'].strip(),
-                ','.join(update_data['days']),
-                ','.join(map(str, update_data['teacher_ids'])),
-                update_data['active'],
-                id
-            ))
-            db.commit()
-            
-            # Get the updated batch data to return
-            batch = db.execute("""
-                SELECT b.id, b.course_id, c.name AS course, b.timeframe_id, 
-                       t.timeframe, b.room_id, r.room_number, 
-                       b.batch_number, b.days, b.teacher_ids, b.active
-                FROM batches b
-                JOIN courses c ON b.course_id = c.id
-                JOIN timeframes t ON b.timeframe_id = t.id
-                JOIN rooms r ON b.room_id = r.id
-                WHERE b.id = ?
-            """, (id,)).fetchone()
-            
-            # Get teacher names
-            teachers = {t['id']: t['name'] for t in db.execute("SELECT id, name FROM teachers").fetchall()}
-            teacher_ids = [int(id) for id in batch['teacher_ids'].split(',') if id.strip()]
-            teacher_names = [teachers.get(id, f"Teacher {id}") for id in teacher_ids]
             
-            return jsonify({
-                "id": batch['id'],
-                "course_id": batch['course_id'],
-                "course": batch['course'],
-                "timeframe_id": batch['timeframe_id'],
-                "timeframe": batch['timeframe'],
-                "room_id": batch['room_id'],
-                "room": batch['room_number'],
-                "batch_number": batch['batch_number'],
-                "days": batch['days'].split(','),
-                "teacher_ids": teacher_ids,
-                "teacher_names": teacher_names,
-                "active": bool(batch['active'])
-            }), 200
+            db_writer.run(update)
+            
+            return batch_response(db, id)
             
         elif request.method == 'DELETE':
-            db.execute("DELETE FROM batches WHERE id = ?", (id,))
-            db.commit()
+            def delete(db):
+                db.execute("DELETE FROM batch_teachers WHERE batch_id = ?", (id,))
+                db.execute("DELETE FROM batch_days WHERE batch_id = ?", (id,))
+                db.execute("DELETE FROM batches WHERE id = ?", (id,))
+                db_writer.after_commit(schedule_index.remove_batch, id)
+            
+            db_writer.run(delete)
             return jsonify({"message": "Batch deleted successfully"}), 200
             
+    except WriteRejected as e:
+        return jsonify(e.body), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Edits accepted by one /api/batches/simulate request
+SIMULATE_MAX_EDITS = int(os.environ.get('SIMULATE_MAX_EDITS', 2000))
+SIMULATED_FIELDS = ('course_id', 'timeframe_id', 'room_id', 'days', 'teacher_ids', 'active')
+
+def merge_intervals(intervals):
+    """[[start, end], ...] covering a start-sorted list of (start, end, batch_id)"""
+    merged = []
+    for start, end, _ in intervals:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+@app.route('/api/batches/simulate', methods=['POST'])
+def simulate_batches():
+    """Dry run of a changeset of batch creates, updates and deletes.
+    
+    The body is {"edits": [...]} with edits {"op": "create", "batch":
+    {...}} taking a POST /api/batches payload, {"op": "update", "id": ...,
+    "batch": {...}} taking the fields to change, and {"op": "delete",
+    "id": ...}. Edits apply in order to copies of the schedule index lists
+    they touch; nothing is written. Created batches are named
+    "new:<edit index>".
+    
+    Returns every teacher and room double booking an edited batch would
+    be part of ("new" when the changeset causes it), the ones it
+    resolves, and the busy time of each resource and day it touches
+    before and after, days in week order. Double bookings between untouched batches are left
+    to /api/audit/conflicts. Invalid edits are listed under "errors" and
+    left out of the result.
+    """
+    data = request.get_json(silent=True)
+    edits = data.get('edits') if isinstance(data, dict) else None
+    if not isinstance(edits, list):
+        return jsonify({"error": "edits must be a list"}), 400
+    if len(edits) > SIMULATE_MAX_EDITS:
+        return jsonify({"error": f"At most {SIMULATE_MAX_EDITS} edits per request"}), 400
+    
+    db = get_db()
+    try:
+        errors = []
+        proposals = []   # (edit index, batch id, fields to set or None to delete)
+        for i, edit in enumerate(edits):
+            op = edit.get('op') if isinstance(edit, dict) else None
+            fields = edit.get('batch') if isinstance(edit, dict) else None
+            try:
+                if op == 'create':
+                    error = validate_batch_data(fields)
+                    if error:
+                        errors.append({"edit": i, "error": error})
+                        continue
+                    batch_id = -(i + 1)
+                elif op in ('update', 'delete'):
+                    batch_id = edit.get('id')
+                    if not isinstance(batch_id, int) or batch_id <= 0:
+                        errors.append({"edit": i, "error": "id must be a batch id"})
+                        continue
+                    if op == 'delete':
+                        proposals.append((i, batch_id, None))
+                        continue
+                    if not isinstance(fields, dict):
+                        errors.append({"edit": i, "error": "batch must be an object"})
+                        continue
+                    if isinstance(fields.get('teacher_ids'), str):
+                        fields['teacher_ids'] = split_ids(fields['teacher_ids'])
+                else:
+                    errors.append({"edit": i, "error": "op must be create, update or delete"})
+                    continue
+                fields = {field: fields[field] for field in SIMULATED_FIELDS if field in fields}
+                if 'days' in fields and (not isinstance(fields['days'], list)
+                                         or not all(day in VALID_DAYS for day in fields['days'])):
+                    errors.append({"edit": i, "error": "Invalid day values"})
+                    continue
+                if 'teacher_ids' in fields:
+                    fields['teacher_ids'] = [int(teacher_id) for teacher_id in fields['teacher_ids']]
+                for field in ('course_id', 'timeframe_id', 'room_id'):
+                    if field in fields:
+                        fields[field] = int(fields[field])
+            except (TypeError, ValueError):
+                errors.append({"edit": i, "error": "Invalid field values"})
+                continue
+            proposals.append((i, batch_id, fields))
+        
+        # Current rows and referenced ids, one query per table
+        def existing(query, ids):
+            return {row[0]: row for row in db.execute(query, (json.dumps(sorted(ids)),)).fetchall()}
+        
+        current = existing("""
+            SELECT id, course_id, timeframe_id, room_id, days, teacher_ids, active
+            FROM batches WHERE id IN (SELECT value FROM json_each(?))
+        """, {batch_id for _, batch_id, _ in proposals if batch_id > 0})
+        proposed = [fields for _, _, fields in proposals if fields]
+        courses = existing("SELECT id FROM courses WHERE id IN (SELECT value FROM json_each(?))",
+                           {fields['course_id'] for fields in proposed if 'course_id' in fields})
+        rooms = existing("SELECT id FROM rooms WHERE id IN (SELECT value FROM json_each(?))",
+                         {fields['room_id'] for fields in proposed if 'room_id' in fields})
+        teachers = existing("SELECT id FROM teachers WHERE id IN (SELECT value FROM json_each(?))",
+                            {teacher_id for fields in proposed for teacher_id in fields.get('teacher_ids', ())})
+        
+        # Final proposed state per batch: a field dict, or None once deleted
+        states = {}
+        for i, batch_id, fields in proposals:
+            if batch_id > 0 and batch_id not in current:
+                errors.append({"edit": i, "error": "Batch not found"})
+                continue
+            if batch_id in states and states[batch_id] is None:
+                errors.append({"edit": i, "error": "Batch is deleted by an earlier edit"})
+                continue
+            if fields is None:
+                states[batch_id] = None
+                continue
+            if batch_id in states:
+                state = dict(states[batch_id])
+            elif batch_id > 0:
+                row = current[batch_id]
+                state = {
+                    'course_id': row['course_id'], 'timeframe_id': row['timeframe_id'],
+                    'room_id': row['room_id'], 'days': row['days'].split(','),
+                    'teacher_ids': split_ids(row['teacher_ids']), 'active': row['active']
+                }
+            else:
+                state = {'active': True}
+            state.update(fields)
+            timeframe = schedule_index.timeframes.get(state['timeframe_id'])
+            if timeframe is None:
+                error = "Timeframe not found"
+            elif timeframe[0] is None or timeframe[1] is None:
+                error = "Invalid timeframe format"
+            elif state['course_id'] not in courses and 'course_id' in fields:
+                error = "Course not found"
+            elif state['room_id'] not in rooms and 'room_id' in fields:
+                error = "Room not found"
+            elif any(teacher_id not in teachers for teacher_id in fields.get('teacher_ids', ())):
+                error = "Teacher not found"
+            else:
+                states[batch_id] = state
+                continue
+            errors.append({"edit": i, "error": error})
+        
+        overlay = schedule_index.what_if(
+            [batch_id for batch_id in states if batch_id > 0],
+            [
+                (batch_id, state['timeframe_id'], state['teacher_ids'], state['days'],
+                 bool(state['active']), state['room_id'])
+                for batch_id, state in states.items() if state is not None
+            ]
+        )
+        
+        def name(batch_id):
+            return batch_id if batch_id > 0 else f"new:{-batch_id - 1}"
+        
+        def booking(kind, resource_id, day, first, second, start, end):
+            return {"kind": kind, "resource_id": resource_id, "day": day, "start_min": start, "end_min": end,
+                    "batch_ids": [name(first), name(second)]}
+        
+        day_order = {day: i for i, day in enumerate(VALID_DAYS)}
+        conflicts, resolved = [], []
+        free_busy = {TEACHER: {}, ROOM: {}}
+        for key in sorted(overlay, key=lambda key: (key[0], key[1], day_order[key[2]])):
+            before, after = overlay[key]
+            pairs_before = overlaps_involving(before, states)
+            pairs_after = overlaps_involving(after, states)
+            for pair, overlap in pairs_after.items():
+                conflicts.append(dict(booking(*key, *overlap), new=pair not in pairs_before))
+            resolved.extend(booking(*key, *overlap) for pair, overlap in pairs_before.items() if pair not in pairs_after)
+            free_busy[key[0]].setdefault(key[1], []).append({
+                "day": key[2],
+                "busy_before": merge_intervals(before),
+                "busy_after": merge_intervals(after)
+            })
+        
+        return jsonify({
+            "edits": len(edits),
+            "applied": len(edits) - len(errors),
+            "errors": sorted(errors, key=lambda error: error['edit']),
+            "conflicts": conflicts,
+            "new_conflicts": sum(1 for conflict in conflicts if conflict['new']),
+            "resolved": resolved,
+            "free_busy": {
+                "teachers": [{"teacher_id": id, "days": days} for id, days in free_busy[TEACHER].items()],
+                "rooms": [{"room_id": id, "days": days} for id, days in free_busy[ROOM].items()]
+            }
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/schedule/solve', methods=['POST'])
+def solve_schedule():
+    """Propose (and optionally commit) a timetable for unscheduled batch requests.
+    
+    Body: {"requests": [{course_id, batch_number, teacher_ids, teachers_needed,
+    days_required, capacity, duration, days, timeframe_ids}], "time_budget",
+    "workers", "seed", "commit"}. teacher_ids lists the eligible teachers;
+    duration, days and timeframe_ids are optional restrictions. A request
+    that no known timeframe can hold is rejected before the solver runs.
+    time_budget is clamped to 0.1-300 seconds.
+    """
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('requests'), list) or not data['requests']:
+        return jsonify({"error": "requests must be a non-empty list"}), 400
+    
+    try:
+        time_budget = float(data.get('time_budget', 5))
+        if not math.isfinite(time_budget):
+            raise ValueError(time_budget)
+        time_budget = max(0.1, min(time_budget, 300))
+        workers = max(1, min(int(data.get('workers', 1)), os.cpu_count() or 1))
+        seed = int(data.get('seed', 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid time_budget, workers or seed"}), 400
+    
+    db = get_db()
+    try:
+        course_ids = {c['id'] for c in db.execute("SELECT id FROM courses").fetchall()}
+        batch_numbers = {
+            (b['course_id'], b['batch_number'])
+            for b in db.execute("SELECT course_id, batch_number FROM batches").fetchall()
+        }
+        timeframes = {
+            id: (start, end) for id, (start, end, _) in schedule_index.timeframes.items()
+            if start is not None and end is not None
+        }
+        
+        # Validate requests
+        requests = []
+        for i, item in enumerate(data['requests']):
+            try:
+                course_id = int(item['course_id'])
+                batch_number = str(item['batch_number']).strip()
+                teacher_ids = [int(teacher_id) for teacher_id in item['teacher_ids']]
+                days_required = int(item['days_required'])
+            except (KeyError, TypeError, ValueError):
+                return jsonify({"error": f"Request {i}: course_id, batch_number, teacher_ids and days_required are required"}), 400
+            try:
+                teachers_needed = int(item.get('teachers_needed', 1))
+            except (TypeError, ValueError):
+                teachers_needed = 0
+            try:
+                duration = int(item.get('duration') or 0)
+                capacity = int(item.get('capacity') or 0)
+                if duration < 0 or capacity < 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                return jsonify({"error": f"Request {i}: duration and capacity must be non-negative integers"}), 400
+            try:
+                timeframe_ids = [int(id) for id in item.get('timeframe_ids') or []]
+            except (TypeError, ValueError):
+                timeframe_ids = None
+            if timeframe_ids is None or not all(id in timeframes for id in timeframe_ids):
+                return jsonify({"error": f"Request {i}: timeframe_ids must list existing timeframes"}), 400
+            if course_id not in course_ids:
+                return jsonify({"error": f"Request {i}: invalid course ID"}), 400
+            if (course_id, batch_number) in batch_numbers:
+                return jsonify({"error": f"Request {i}: batch with this number already exists for this course"}), 400
+            if not 1 <= days_required <= len(VALID_DAYS):
+                return jsonify({"error": f"Request {i}: days_required must be between 1 and 7"}), 400
+            if not 1 <= teachers_needed <= len(teacher_ids):
+                return jsonify({"error": f"Request {i}: teachers_needed must be between 1 and the number of teacher_ids"}), 400
+            if not all(day in VALID_DAYS for day in item.get('days') or []):
+                return jsonify({"error": f"Request {i}: invalid day values"}), 400
+            # The solver would spend its whole budget retrying a request it can never place
+            if not any(end - start >= duration for id, (start, end) in timeframes.items()
+                       if not timeframe_ids or id in timeframe_ids):
+                return jsonify({"error": f"Request {i}: no timeframe is long enough for the duration"}), 400
+            batch_numbers.add((course_id, batch_number))
+            requests.append(dict(item, course_id=course_id, batch_number=batch_number, teacher_ids=teacher_ids,
+                                 teachers_needed=teachers_needed, days_required=days_required,
+                                 duration=duration, capacity=capacity, timeframe_ids=timeframe_ids))
+        
+        rooms = {r['id']: r['capacity'] for r in db.execute("SELECT id, capacity FROM rooms").fetchall()}
+        existing = [
+            (split_ids(b['teacher_ids']), b['room_id'], b['timeframe_id'], b['days'].split(','))
+            for b in db.execute(
+                "SELECT timeframe_id, room_id, days, teacher_ids FROM batches WHERE active = 1"
+            ).fetchall()
+        ]
+        
+        result = solver.solve(requests, timeframes, rooms, existing, time_budget, workers, seed)
+        for assignment in result['assignments']:
+            item = requests[assignment['request']]
+            assignment.update(course_id=item['course_id'], batch_number=item['batch_number'])
+        result['unscheduled'] = [
+            {"request": i, "course_id": requests[i]['course_id'], "batch_number": requests[i]['batch_number']}
+            for i in result['unscheduled']
+        ]
+        result['committed'] = False
+        
+        if data.get('commit') and result['assignments']:
+            rows = [
+                (a['course_id'], a['timeframe_id'], a['room_id'], a['batch_number'],
+                 ','.join(a['days']), ','.join(map(str, a['teacher_ids'])), True)
+                for a in result['assignments']
+            ]
+            
+            def commit_assignments(db):
+                # The schedule may have changed while the solver ran; re-check
+                # every assignment's teachers and room inside the write transaction
+                clashes = []
+                for assignment in result['assignments']:
+                    conflict_check = check_schedule_conflict(
+                        assignment['teacher_ids'], assignment['days'], assignment['timeframe_id'], db=db
+                    )
+                    if not (conflict_check.get('conflict') or 'error' in conflict_check):
+                        room_clash = db.execute(f"""
+                            SELECT o.day, o.batch_id
+                            FROM occupancy o
+                            JOIN timeframes t ON t.id = ?
+                            WHERE o.room_id = ?
+                              AND o.day IN ({','.join('?' * len(assignment['days']))})
+                              AND o.start_min < t.end_min AND o.end_min > t.start_min
+                            LIMIT 1
+                        """, [assignment['timeframe_id'], assignment['room_id'], *assignment['days']]).fetchone()
+                        if room_clash is None:
+                            continue
+                        conflict_check = {
+                            "conflict": True,
+                            "room_id": assignment['room_id'],
+                            "day": room_clash['day'],
+                            "conflicting_batch": room_clash['batch_id']
+                        }
+                    clashes.append(dict(conflict_check, request=assignment['request']))
+                if clashes:
+                    raise WriteRejected({
+                        "error": "Schedule changed while solving",
+                        "requests": [clash['request'] for clash in clashes],
+                        "details": clashes,
+                        "proposal": result
+                    }, 409)
+                new_ids = insert_batches(db, rows)
+                db_writer.after_commit(index_batches, new_ids, rows)
+                return new_ids
+            
+            try:
+                new_ids = db_writer.run(commit_assignments)
+            except WriteRejected as e:
+                return jsonify(e.body), e.status
+            for assignment, batch_id in zip(result['assignments'], new_ids):
+                assignment['id'] = batch_id
+            publish_index_change('batches', 'reload', data={"ids": new_ids})
+            bump_generation('batches')
+            result['committed'] = True
+        
+        return jsonify(result), 201 if result['committed'] else 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/events', methods=['GET'])
+def change_events():
+    """Server-Sent Events stream of committed writes.
+    
+    Each event carries {"entity", "op", "id", "data"} where entity is the
+    table name, op is create, update, delete or reload and data is the new
+    row for creates and updates. Reconnecting clients resume from
+    Last-Event-ID; if that is too old a single "reset" event tells them to
+    reload. Streams end after EVENTS_MAX_STREAM_SECONDS so worker threads
+    are recycled; EventSource reconnects on its own.
+    
+    At most EVENTS_MAX_STREAMS streams are open per worker; past that the
+    request is answered with 503 and a ``retry:`` field, so live updates
+    can never take every thread away from the rest of the API.
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"error": "Invalid event id"}), 400
+    
+    if not _event_streams.acquire(blocking=False):
+        retry_seconds = -(-EVENTS_RETRY_MS // 1000)
+        return Response(f"retry: {EVENTS_RETRY_MS}\n\n", status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(retry_seconds), 'Cache-Control': 'no-cache'})
+    
+    # The stream outlives the request context
+    feed = current_shard().change_feed
+    
+    def stream():
+        start = feed.latest() if last_id is None else last_id
+        yield f"retry: 3000\nid: {start}\n\n"
+        for event in feed.subscribe(start, max_seconds=EVENTS_MAX_STREAM_SECONDS):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                event_id, record = event
+                yield f"id: {event_id}\ndata: {json.dumps(record, separators=(',', ':'))}\n\n"
+    
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs when the server closes the body, also if it was never iterated
+    response.call_on_close(_event_streams.release)
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of the request, SQL and conflict-check metrics.
+    
+    With METRICS_DIR set the values are totals over all worker processes,
+    at most METRICS_EXPORT_INTERVAL seconds behind for the other workers.
+    """
+    return Response(metrics.render(app.config['METRICS_DIR']), mimetype='text/plain; version=0.0.4')
+
+def resource_schedule(db, kind, resource_id):
+    """Weekly timetable of one teacher or room, read from the schedule index.
+    
+    Only the batches the resource actually holds are loaded, by primary
+    key, so the cost does not grow with the size of the batch table. Days
+    are a list in week order, since JSON objects come out sorted by key.
+    """
+    week = schedule_index.week(kind, resource_id, VALID_DAYS)
+    batch_ids = sorted({batch_id for intervals in week.values() for _, _, batch_id in intervals})
+    batches = {}
+    if batch_ids:
+        batches = {batch['id']: batch for batch in iter_batches(
+            db, [f"b.id IN ({','.join('?' * len(batch_ids))})"], batch_ids
+        )}
+    
+    days = []
+    total_minutes = 0
+    for day in VALID_DAYS:
+        day_batches = []
+        for start, end, batch_id in week[day]:
+            batch = batches.get(batch_id)
+            if batch is None:
+                continue
+            day_batches.append(dict(batch, start_min=start, end_min=end))
+            total_minutes += end - start
+        days.append({"day": day, "batches": day_batches})
+    return days, total_minutes
+
+@app.route('/api/teachers/<int:id>/schedule', methods=['GET'])
+@tracks_table('batches', 'teachers', 'courses', 'timeframes', 'rooms')
+def teacher_schedule(id):
+    """Active batches of one teacher grouped by day, sorted by start time"""
+    db = get_db()
+    try:
+        teacher = db.execute("SELECT id, name FROM teachers WHERE id = ?", (id,)).fetchone()
+        if not teacher:
+            return jsonify({"error": "Teacher not found"}), 404
+        
+        days, total_minutes = resource_schedule(db, TEACHER, id)
+        return jsonify({
+            "teacher_id": teacher['id'],
+            "teacher_name": teacher['name'],
+            "days": days,
+            "total_minutes": total_minutes
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rooms/<int:id>/schedule', methods=['GET'])
+@tracks_table('batches', 'teachers', 'courses', 'timeframes', 'rooms')
+def room_schedule(id):
+    """Active batches held in one room grouped by day, sorted by start time"""
+    db = get_db()
+    try:
+        room = db.execute("SELECT id, room_number FROM rooms WHERE id = ?", (id,)).fetchone()
+        if not room:
+            return jsonify({"error": "Room not found"}), 404
+        
+        days, total_minutes = resource_schedule(db, ROOM, id)
+        return jsonify({
+            "room_id": room['id'],
+            "room": room['room_number'],
+            "days": days,
+            "total_minutes": total_minutes
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Flat, fully joined batch rows behind the CSV and iCalendar exports
+EXPORT_SELECT = f"""
+    SELECT b.id, c.name AS course, b.batch_number, t.timeframe, t.start_time, t.end_time,
+           t.start_min, t.end_min, r.room_number AS room, b.days, b.teacher_ids,
+           (
+               SELECT group_concat(COALESCE(tt.name, 'Teacher ' || j.value), '; ')
+               FROM json_each('[' || b.teacher_ids || ']') j
+               LEFT JOIN teachers tt ON tt.id = j.value
+           ) AS teacher_names,
+           b.active
+    {BATCH_FROM}
+"""
+
+def iter_export_rows(db, where=(), params=(), chunk_size=500):
+    """Yield export rows in (course name, batch_number, id) order, read in chunks"""
+    query = EXPORT_SELECT
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY c.name, b.batch_number, b.id"
+    
+    cursor = db.execute(query, list(params))
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        yield from chunk
+
+@app.route('/api/export/schedule.csv', methods=['GET'])
+def export_schedule_csv():
+    """Stream the fully joined schedule as CSV (see exports.CSV_COLUMNS).
+    
+    Accepts the same filters as GET /api/batches; rows are written out
+    as they are read, a chunk at a time.
+    """
+    try:
+        where, params = batch_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    rows = (
+        (
+            row['id'], row['course'], row['batch_number'], row['timeframe'],
+            row['start_time'], row['end_time'], row['room'],
+            row['days'].replace(',', ';'), row['teacher_ids'].replace(',', ';'),
+            row['teacher_names'], 1 if row['active'] else 0
+        )
+        for row in iter_export_rows(get_db(), where, params)
+    )
+    response = Response(stream_with_context(exports.iter_csv(exports.CSV_COLUMNS, rows)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename="schedule.csv"'
+    return response
+
+def calendar_response(kind, resource_id):
+    """iCalendar feed with one weekly recurring event per active batch of a teacher or room"""
+    db = get_db()
+    if kind == TEACHER:
+        resource = db.execute("SELECT name FROM teachers WHERE id = ?", (resource_id,)).fetchone()
+        where = "b.id IN (SELECT batch_id FROM batch_teachers WHERE teacher_id = ?)"
+    else:
+        resource = db.execute("SELECT room_number AS name FROM rooms WHERE id = ?", (resource_id,)).fetchone()
+        where = "b.room_id = ?"
+    if not resource:
+        return jsonify({"error": f"{kind.title()} not found"}), 404
+    
+    events = (
+        {
+            "uid": f"batch-{row['id']}@teacher-scheduler",
+            "summary": f"{row['course']} - Batch {row['batch_number']}",
+            "location": row['room'],
+            "description": f"Teachers: {row['teacher_names']}",
+            "days": row['days'].split(','),
+            "start_min": row['start_min'],
+            "end_min": row['end_min']
+        }
+        for row in iter_export_rows(db, [where, "b.active = 1"], [resource_id])
+    )
+    # Series start in the current week; the feed is cached per generation
+    # by tracks_table, so the anchor only moves when the schedule changes
+    body = exports.iter_calendar(
+        f"{resource['name']} schedule", events,
+        exports.week_start(date.today()), datetime.now(timezone.utc)
+    )
+    response = Response(stream_with_context(body), mimetype='text/calendar')
+    response.headers['Content-Disposition'] = f'inline; filename="{kind}-{resource_id}.ics"'
+    return response
+
+@app.route('/api/teachers/<int:id>/calendar.ics', methods=['GET'])
+@tracks_table('batches', 'teachers', 'courses', 'timeframes', 'rooms')
+def teacher_calendar(id):
+    return calendar_response(TEACHER, id)
+
+@app.route('/api/rooms/<int:id>/calendar.ics', methods=['GET'])
+@tracks_table('batches', 'teachers', 'courses', 'timeframes', 'rooms')
+def room_calendar(id):
+    return calendar_response(ROOM, id)
+
+@app.route('/api/import/schedule.csv', methods=['POST'])
+@tracks_table('batches')
+def import_schedule_csv():
+    """Create batches from a CSV in the export format, in one transaction.
+    
+    The body is parsed as it is read. Courses, rooms and timeframes are
+    matched by course, room and start_time/end_time (course_id, room_id
+    and timeframe_id columns take precedence when present); id and the
+    name columns are ignored. Every row is checked against the schedule,
+    including the rows imported before it. Rows that fail are skipped and
+    reported; the response lists the outcome of each row like
+    /api/batches/bulk.
+    """
+    reader = csv.DictReader(codecs.iterdecode(request.stream, 'utf-8-sig'))
+    required = {'batch_number', 'days', 'teacher_ids'}
+    try:
+        if not reader.fieldnames or not required <= set(reader.fieldnames):
+            return jsonify({"error": f"CSV header must include {', '.join(sorted(required))}"}), 400
+        rows = []
+        for data in reader:
+            rows.append({
+                'course': data.get('course_id') or data.get('course'),
+                'by_id': {field: bool(data.get(field)) for field in ('course_id', 'room_id', 'timeframe_id')},
+                'room': data.get('room_id') or data.get('room'),
+                'timeframe_id': data.get('timeframe_id'),
+                'start_time': validate_time(data.get('start_time') or ''),
+                'end_time': validate_time(data.get('end_time') or ''),
+                'batch_number': (data.get('batch_number') or '').strip(),
+                'days': exports.split_list(data.get('days') or ''),
+                'teacher_ids': exports.split_list(data.get('teacher_ids') or ''),
+                'active': (data.get('active') or '1').strip().lower() in ('1', 'true', 'yes')
+            })
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": f"Invalid CSV: {e}"}), 400
+    
+    def import_rows(db):
+        course_names = {c['name']: c['id'] for c in db.execute("SELECT id, name FROM courses").fetchall()}
+        room_numbers = {r['room_number']: r['id'] for r in db.execute("SELECT id, room_number FROM rooms").fetchall()}
+        timeframe_times = {
+            (t['start_time'], t['end_time']): t['id']
+            for t in db.execute("SELECT id, start_time, end_time FROM timeframes").fetchall()
+        }
+        teacher_ids = {t['id'] for t in db.execute("SELECT id FROM teachers").fetchall()}
+        
+        errors = []
+        payloads = []
+        for row_number, row in enumerate(rows):
+            by_id = row['by_id']
+            try:
+                payload = {
+                    'course_id': int(row['course']) if by_id['course_id'] else course_names.get(row['course'], 0),
+                    'room_id': int(row['room']) if by_id['room_id'] else room_numbers.get(row['room'], 0),
+                    'timeframe_id': (int(row['timeframe_id']) if by_id['timeframe_id']
+                                     else timeframe_times.get((row['start_time'], row['end_time']), 0)),
+                    'batch_number': row['batch_number'],
+                    'days': row['days'],
+                    'teacher_ids': [int(teacher_id) for teacher_id in row['teacher_ids']],
+                    'active': row['active']
+                }
+            except ValueError:
+                errors.append({"row": row_number, "status": "error", "error": "Invalid batch values"})
+                continue
+            if not row['batch_number'] or not row['days'] or not payload['teacher_ids']:
+                error = "batch_number, days and teacher_ids are required"
+            elif not all(teacher_id in teacher_ids for teacher_id in payload['teacher_ids']):
+                error = "Unknown teacher"
+            else:
+                payloads.append((row_number, payload))
+                continue
+            errors.append({"row": row_number, "status": "error", "error": error})
+        
+        # Unknown courses, rooms and timeframes resolve to id 0 and are
+        # reported by create_batches like in a bulk request
+        results, created = create_batches(db, payloads)
+        return sorted(results + errors, key=lambda result: result['row']), created
+    
+    try:
+        results, created = db_writer.run(import_rows)
+        return jsonify({
+            "created": len(created),
+            "failed": len(results) - len(created),
+            "results": results
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/audit/conflicts', methods=['GET'])
+@tracks_table('batches', 'teachers', 'courses', 'timeframes', 'rooms')
+def audit_conflicts():
+    """Every teacher and room double booking in the schedule, grouped by resource.
+    
+    Each (resource, day) interval list in the schedule index is swept
+    once. ``kind=teacher|room`` and ``day`` narrow the report. Conflicts
+    name their two batches by id; the batches map describes each once.
+    """
+    kind = request.args.get('kind')
+    day = request.args.get('day')
+    if kind not in (None, TEACHER, ROOM):
+        return jsonify({"error": "kind must be teacher or room"}), 400
+    if day is not None and day not in VALID_DAYS:
+        return jsonify({"error": "Invalid day value"}), 400
+    
+    db = get_db()
+    try:
+        conflicts = [c for c in schedule_index.conflicts(kind) if day is None or c[2] == day]
+        
+        # Names for everything involved, looked up in one query per table
+        def lookup(query, ids):
+            return {row[0]: row[1:] for row in db.execute(query, (json.dumps(sorted(ids)),)).fetchall()}
+        
+        batch_ids = {batch_id for c in conflicts for batch_id in c[3:5]}
+        batches = lookup("""
+            SELECT b.id, c.name, b.batch_number, t.timeframe
+            FROM batches b
+            JOIN courses c ON c.id = b.course_id
+            JOIN timeframes t ON t.id = b.timeframe_id
+            WHERE b.id IN (SELECT value FROM json_each(?))
+        """, batch_ids)
+        names = {
+            TEACHER: lookup("SELECT id, name FROM teachers WHERE id IN (SELECT value FROM json_each(?))",
+                            {c[1] for c in conflicts if c[0] == TEACHER}),
+            ROOM: lookup("SELECT id, room_number FROM rooms WHERE id IN (SELECT value FROM json_each(?))",
+                         {c[1] for c in conflicts if c[0] == ROOM}),
+        }
+        
+        grouped = {TEACHER: {}, ROOM: {}}
+        for resource_kind, resource_id, conflict_day, first, second, start, end in conflicts:
+            grouped[resource_kind].setdefault(resource_id, []).append({
+                "day": conflict_day,
+                "start_min": start,
+                "end_min": end,
+                "batch_ids": [first, second]
+            })
+        
+        day_order = {name: i for i, name in enumerate(VALID_DAYS)}
+        def resources(resource_kind, id_field, name_field):
+            return [
+                {
+                    id_field: resource_id,
+                    name_field: (names[resource_kind].get(resource_id) or (None,))[0],
+                    "conflicts": sorted(items, key=lambda item: (day_order[item['day']], item['start_min']))
+                }
+                for resource_id, items in sorted(grouped[resource_kind].items())
+            ]
+        
+        # Batches are described once, conflicts refer to them by id
+        return jsonify({
+            "total": len(conflicts),
+            "teachers": resources(TEACHER, "teacher_id", "teacher_name"),
+            "rooms": resources(ROOM, "room_id", "room"),
+            "batches": {
+                batch_id: {"course": course, "batch_number": batch_number, "timeframe": timeframe}
+                for batch_id, (course, batch_number, timeframe) in batches.items()
+            }
+        })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
 
 @app.route('/api/dashboard', methods=['GET'])
 def dashboard():
+    """Busy/free status of every teacher for batches held in exactly one timeframe on one day"""
     day = request.args.get('day')
     timeframe_id = request.args.get('timeframe_id')
     
@@ -657,7 +2730,7 @@ def dashboard():
     try:
         # Get timeframe info
         timeframe = db.execute(
-            "SELECT timeframe, start_time, end_time FROM timeframes WHERE id = ?",
+            "SELECT timeframe, start_min, end_min, start_label, end_label FROM timeframes WHERE id = ?",
             (timeframe_id,)
         ).fetchone()
         
@@ -667,27 +2740,31 @@ def dashboard():
         # Get all teachers
         teachers = db.execute("SELECT id, name FROM teachers ORDER BY name").fetchall()
         
-        # Get batches for this day and timeframe
+        # Active batches held in exactly this slot on this day, one row per
+        # assigned teacher, from an equality lookup on occupancy
         batches = db.execute("""
-            SELECT b.id, b.teacher_ids, c.name AS course, b.batch_number, r.room_number
-            FROM batches b
+            SELECT o.teacher_id, o.batch_id AS id, c.name AS course, b.batch_number, r.room_number
+            FROM occupancy o
+            JOIN batches b ON b.id = o.batch_id
             JOIN courses c ON b.course_id = c.id
-            JOIN rooms r ON b.room_id = r.id
-            WHERE b.days LIKE ? AND b.timeframe_id = ? AND b.active = 1
-        """, (f'%{day}%', timeframe_id)).fetchall()
+            JOIN rooms r ON r.id = o.room_id
+            WHERE o.day = ? AND o.start_min = ? AND o.end_min = ? AND b.timeframe_id = ?
+            ORDER BY o.batch_id
+        """, (day, timeframe['start_min'], timeframe['end_min'], timeframe_id)).fetchall()
+        
+        batches_by_teacher = {}
+        for batch in batches:
+            batches_by_teacher.setdefault(batch['teacher_id'], []).append({
+                "batch_id": batch['id'],
+                "course": batch['course'],
+                "batch_number": batch['batch_number'],
+                "room": batch['room_number']
+            })
         
         # Prepare results
         results = []
         for teacher in teachers:
-            teacher_batches = []
-            for batch in batches:
-                if str(teacher['id']) in batch['teacher_ids'].split(','):
-                    teacher_batches.append({
-                        "batch_id": batch['id'],
-                        "course": batch['course'],
-                        "batch_number": batch['batch_number'],
-                        "room": batch['room_number']
-                    })
+            teacher_batches = batches_by_teacher.get(teacher['id'], [])
             
             results.append({
                 "teacher_id": teacher['id'],
@@ -699,14 +2776,193 @@ def dashboard():
         return jsonify({
             "day": day,
             "timeframe": timeframe['timeframe'],
-            "start_time": format_time_12h(timeframe['start_time']),
-            "end_time": format_time_12h(timeframe['end_time']),
+            "start_time": timeframe['start_label'],
+            "end_time": timeframe['end_label'],
             "teachers": results
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        db.close()
+
+@app.route('/api/availability/week', methods=['GET'])
+def availability_week():
+    """Teacher x day x timeframe busy matrix for the whole week in one response.
+    
+    ``encoding=packed`` returns the matrix as base64 bits (teacher-major,
+    then day, then timeframe) instead of nested lists; ``slots=1`` adds
+    each teacher's raw 5-minute occupancy bitmap for every day.
+    """
+    encoding = request.args.get('encoding', 'json')
+    if encoding not in ('json', 'packed'):
+        return jsonify({"error": "encoding must be json or packed"}), 400
+    
+    db = get_db()
+    try:
+        teachers = db.execute("SELECT id, name FROM teachers ORDER BY name").fetchall()
+        timeframes = sorted(
+            (tf for tf in schedule_index.timeframes.items() if tf[1][0] is not None and tf[1][1] is not None),
+            key=lambda tf: (tf[1][0], tf[1][1])
+        )
+        
+        occupied = occupancy_cache.bitmaps(TEACHER, [teacher['id'] for teacher in teachers])
+        busy = availability.busy_matrix(
+            occupied, availability.window_masks([(start, end) for _, (start, end, _) in timeframes])
+        )
+        
+        result = {
+            "days": availability.DAYS,
+            "timeframes": [{"id": id, "timeframe": label} for id, (_, _, label) in timeframes],
+            "teachers": [{"id": teacher['id'], "name": teacher['name']} for teacher in teachers],
+            "encoding": encoding,
+            "shape": list(busy.shape)
+        }
+        if encoding == 'packed':
+            result["busy"] = availability.pack(busy)
+        else:
+            result["busy"] = busy.astype(int).tolist()
+        
+        if request.args.get('slots') == '1':
+            result["slot_minutes"] = availability.SLOT_MINUTES
+            result["slots"] = [availability.pack(teacher_slots) for teacher_slots in occupied]
+        
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/availability/search', methods=['GET'])
+def availability_search():
+    """Find when a set of teachers (and optionally a room) are all free.
+    
+    Query parameters: teacher_ids (comma-separated), room_id, duration in
+    minutes, days (comma-separated, default all week) and the earliest and
+    latest times to consider. Returns every free window long enough for the
+    duration and every existing timeframe that fits, best matches first.
+    """
+    try:
+        teacher_ids = split_ids(request.args.get('teacher_ids', ''))
+    except ValueError:
+        return jsonify({"error": "teacher_ids must be a comma-separated list of ids"}), 400
+    room_id = request.args.get('room_id')
+    if room_id is not None:
+        try:
+            room_id = int(room_id)
+        except ValueError:
+            return jsonify({"error": "room_id must be an integer id"}), 400
+    duration = request.args.get('duration', type=int)
+    days = [day.strip() for day in request.args.get('days', ','.join(VALID_DAYS)).split(',') if day.strip()]
+    
+    if not teacher_ids and room_id is None:
+        return jsonify({"error": "teacher_ids or room_id is required"}), 400
+    if not duration or duration <= 0:
+        return jsonify({"error": "duration must be a positive number of minutes"}), 400
+    if not all(day in VALID_DAYS for day in days):
+        return jsonify({"error": "Invalid day values"}), 400
+    
+    earliest = time_to_minutes(request.args.get('earliest', '07:00'))
+    latest = time_to_minutes(request.args.get('latest', '22:00'))
+    if earliest is None or latest is None or earliest >= latest:
+        return jsonify({"error": "Invalid earliest/latest time"}), 400
+    
+    try:
+        busy = occupancy_cache.combined(teacher_ids, [room_id] if room_id is not None else [])
+        
+        # Only slots fully inside [earliest, latest) are candidates
+        slot = availability.SLOT_MINUTES
+        lo, hi = -(-earliest // slot), latest // slot
+        min_slots = -(-duration // slot)
+        
+        windows = []
+        for day in days:
+            free = ~busy[availability.DAY_INDEX[day], lo:hi]
+            for start, end in availability.free_runs(free, min_slots):
+                start_minute, end_minute = (lo + start) * slot, (lo + end) * slot
+                windows.append({
+                    "day": day,
+                    "start_time": f"{start_minute // 60:02d}:{start_minute % 60:02d}",
+                    "end_time": f"{end_minute // 60:02d}:{end_minute % 60:02d}",
+                    "minutes": end_minute - start_minute
+                })
+        # Longest windows first, then in week order
+        windows.sort(key=lambda w: (-w['minutes'], VALID_DAYS.index(w['day']), w['start_time']))
+        
+        candidates = [
+            (id, start, end, label) for id, (start, end, label) in schedule_index.timeframes.items()
+            if start is not None and end is not None and end - start >= duration
+        ]
+        masks = availability.window_masks([(start, end) for _, start, end, _ in candidates])
+        day_rows = busy[[availability.DAY_INDEX[day] for day in days]]
+        # (timeframes, days): True where the timeframe is free on that day
+        fits = ~availability.busy_matrix(day_rows[None], masks)[0].T
+        
+        timeframes = []
+        for (id, start, end, label), free_days in zip(candidates, fits):
+            matching = [day for day, free in zip(days, free_days) if free]
+            if matching:
+                timeframes.append({
+                    "timeframe_id": id,
+                    "timeframe": label,
+                    "free_days": matching,
+                    "minutes": end - start
+                })
+        # Timeframes free on the most days first, then the tightest fit
+        timeframes.sort(key=lambda tf: (-len(tf['free_days']), tf['minutes'], tf['timeframe_id']))
+        
+        return jsonify({
+            "teacher_ids": teacher_ids,
+            "room_id": room_id,
+            "duration": duration,
+            "timeframes": timeframes,
+            "windows": windows
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Health checks
+@app.route('/api/health')
+def health():
+    """Liveness: the worker is up and answering requests"""
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+@app.route('/api/ready')
+def ready():
+    """Readiness: the database is reachable, migrated and the schedule index is loaded.
+    
+    Checks the selected campus, or every campus when none is selected.
+    """
+    selected = _current_shard.get()
+    versions = {}
+    for shard in [selected] if selected else _shards.values():
+        try:
+            with using_shard(shard), app.app_context():
+                get_db().execute("SELECT 1 FROM batches LIMIT 1").fetchall()
+                sync_schedule_index()
+        except Exception as e:
+            return jsonify({"status": "unavailable", "campus": shard.name, "error": str(e)}), 503
+        versions[shard.name] = shard.schedule_index.version
+    if not app.config['CAMPUSES']:
+        return jsonify({"status": "ready", "pid": os.getpid(), "index_version": versions[None]})
+    return jsonify({"status": "ready", "pid": os.getpid(), "index_versions": versions})
+
+def create_app(config=None, initialize=True):
+    """Prepare the application for serving and return it.
+    
+    ``config`` overrides app.config; the campus shards are set up from
+    it here, so this must run before the server forks. With
+    ``initialize`` every shard's schema is created or migrated; run that
+    once, in the process that forks the workers (see gunicorn.conf.py),
+    not in every worker. The schedule indexes are built here as well so
+    forked workers inherit them; workers started without them build their
+    own on the first API request.
+    """
+    if config:
+        app.config.update(config)
+    configure_shards()
+    if initialize:
+        init_db()
+    for shard in _shards.values():
+        with using_shard(shard):
+            load_schedule_index()
+    close_idle_connections()
+    return app
 
 # Frontend serving
 @app.route('/')
@@ -718,6 +2974,9 @@ def serve_static(path):
     return send_from_directory(app.static_folder, path)
 
 if __name__ == '__main__':
-    if not os.path.exists(DATABASE):
-        init_db()
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    # Development server; production runs `gunicorn -c gunicorn.conf.py wsgi:app`
+    create_app().run(
+        host='0.0.0.0',
+        port=int(os.environ.get('PORT', 8000)),
+        debug=os.environ.get('FLASK_DEBUG') == '1'
+    )
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""Bitset occupancy engine for whole-week free/busy queries"""
+import base64
+import threading
+
+import numpy as np
+
+from schedule_index import TEACHER, ROOM
+
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+DAY_INDEX = {day: i for i, day in enumerate(DAYS)}
+
+
+def occupancy_bitmaps(intervals, rows):
+    """Build a (len(rows), 7, SLOTS_PER_DAY) boolean occupancy array.
+
+    ``intervals`` yields (key, day, start_minute, end_minute) and ``rows``
+    maps each key to its row in the result; unknown keys and days are
+    ignored. Each interval marks every 5-minute slot it touches.
+    """
+    intervals = [
+        (rows[key], DAY_INDEX[day], start, end)
+        for key, day, start, end in intervals
+        if key in rows and day in DAY_INDEX
+    ]
+    delta = np.zeros((len(rows) * len(DAYS), SLOTS_PER_DAY + 1), dtype=np.int32)
+    if intervals:
+        row, day, start, end = np.array(intervals, dtype=np.int64).T
+        line = row * len(DAYS) + day
+        np.add.at(delta, (line, np.clip(start // SLOT_MINUTES, 0, SLOTS_PER_DAY)), 1)
+        np.add.at(delta, (line, np.clip(-(-end // SLOT_MINUTES), 0, SLOTS_PER_DAY)), -1)
+    occupied = np.cumsum(delta, axis=1)[:, :SLOTS_PER_DAY] > 0
+    return occupied.reshape(len(rows), len(DAYS), SLOTS_PER_DAY)
+
+
+def window_masks(windows):
+    """Slot masks of shape (len(windows), SLOTS_PER_DAY) for (start, end) minute pairs"""
+    slots = np.arange(SLOTS_PER_DAY) * SLOT_MINUTES
+    if not windows:
+        return np.zeros((0, SLOTS_PER_DAY), dtype=bool)
+    starts, ends = np.array(windows, dtype=np.int64).T
+    return (slots[None, :] + SLOT_MINUTES > starts[:, None]) & (slots[None, :] < ends[:, None])
+
+
+def busy_matrix(occupied, masks):
+    """(rows, 7, windows) matrix: True where any occupied slot falls inside the window"""
+    rows, days, slots = occupied.shape
+    hits = occupied.reshape(rows * days, slots).astype(np.uint16) @ masks.T.astype(np.uint16)
+    return (hits > 0).reshape(rows, days, len(masks))
+
+
+def pack(matrix):
+    """Pack a boolean array into base64 (row-major, most significant bit first)"""
+    return base64.b64encode(np.packbits(matrix, axis=None).tobytes()).decode('ascii')
+
+
+def free_runs(free, min_slots):
+    """(start_slot, end_slot) runs of True in a 1-D mask that are at least min_slots long"""
+    edges = np.diff(np.concatenate(([0], free.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = ends - starts >= min_slots
+    return list(zip(starts[keep].tolist(), ends[keep].tolist()))
+
+
+class OccupancyCache:
+    """Per-teacher and per-room bitmaps derived from a ScheduleIndex.
+
+    The bitmaps are rebuilt lazily, only when the index version has moved
+    since the last build, so repeated searches share one precomputed copy.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self._lock = threading.Lock()
+        self._version = None
+        self._bitmaps = {}
+
+    def _refresh(self):
+        with self._lock:
+            if self._version == self.index.version:
+                return self._bitmaps
+            version = self.index.version
+            bitmaps = {}
+            for kind in (TEACHER, ROOM):
+                entries = self.index.entries(kind)
+                rows = {resource_id: i for i, resource_id in enumerate(sorted({e[0] for e in entries}))}
+                bitmaps[kind] = (rows, occupancy_bitmaps((e[:4] for e in entries), rows))
+            self._bitmaps, self._version = bitmaps, version
+            return bitmaps
+
+    def bitmaps(self, kind, resource_ids):
+        """(len(resource_ids), 7, SLOTS_PER_DAY) occupancy; unknown resources are all free"""
+        rows, occupied = self._refresh()[kind]
+        result = np.zeros((len(resource_ids), len(DAYS), SLOTS_PER_DAY), dtype=bool)
+        found = [(i, rows[resource_id]) for i, resource_id in enumerate(resource_ids) if resource_id in rows]
+        if found:
+            target, source = zip(*found)
+            result[list(target)] = occupied[list(source)]
+        return result
+
+    def combined(self, teacher_ids, room_ids=()):
+        """(7, SLOTS_PER_DAY) mask of slots where any of the given resources is busy"""
+        busy = np.zeros((len(DAYS), SLOTS_PER_DAY), dtype=bool)
+        if teacher_ids:
+            busy |= self.bitmaps(TEACHER, list(teacher_ids)).any(axis=0)
+        if room_ids:
+            busy |= self.bitmaps(ROOM, list(room_ids)).any(axis=0)
+        return busy
@@ -0,0 +1,335 @@
+"""Benchmark harness for the scheduling API.
+
+Fills a scratch database with seeded synthetic data, drives every /api/*
+route through the Flask test client (sequentially and, with --concurrency,
+from several threads at once) and writes latency percentiles, throughput
+and SQL statements per request to a JSON file so runs can be compared.
+
+    python bench.py --size medium --requests 200 --concurrency 8 --output bench.json
+"""
+import argparse
+import contextvars
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SIZES = {
+    # teachers, courses, rooms, timeframes, batches
+    'small': (100, 20, 30, 8, 500),
+    'medium': (1000, 100, 200, 12, 5000),
+    'large': (10000, 500, 1000, 16, 50000),
+}
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def generate(teachers, courses, rooms, timeframes, batches, seed):
+    """Fill a fresh database with seeded data; batches never double-book a teacher"""
+    import app
+
+    rng = random.Random(seed)
+    with app.app.app_context():
+        db = app.get_db()
+        db.executemany(
+            "INSERT INTO teachers (name, phone) VALUES (?, ?)",
+            [(f"Teacher {i:05d}", f"+1555{i:07d}") for i in range(teachers)]
+        )
+        db.executemany(
+            "INSERT INTO courses (name, description) VALUES (?, ?)",
+            [(f"Course {i:04d}", "") for i in range(courses)]
+        )
+        db.executemany(
+            "INSERT INTO rooms (room_number, capacity) VALUES (?, ?)",
+            [(f"R{i:04d}", rng.choice([15, 25, 40])) for i in range(rooms)]
+        )
+        # Back-to-back 90 minute slots from 8:00, plus a few overlapping ones
+        slots = []
+        for i in range(timeframes):
+            start = 8 * 60 + (i * 90 if i < 9 else (i - 9) * 90 + 45)
+            end = min(start + 90, 1440)
+            slots.append((start, end))
+        for start, end in slots:
+            start_time, end_time = f"{start // 60:02d}:{start % 60:02d}", f"{end // 60:02d}:{end % 60:02d}"
+            start_label, end_label = app.format_time_12h(start_time), app.format_time_12h(end_time)
+            db.execute(
+                """INSERT INTO timeframes
+                (timeframe, start_time, end_time, start_min, end_min, start_label, end_label)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (f"{start_label} - {end_label}", start_time, end_time, start, end, start_label, end_label)
+            )
+        db.commit()
+
+        timeframe_rows = db.execute("SELECT id, start_min, end_min FROM timeframes").fetchall()
+        busy = {}
+        rows = []
+        attempts = 0
+        while len(rows) < batches and attempts < batches * 20:
+            attempts += 1
+            tf = rng.choice(timeframe_rows)
+            days = sorted(rng.sample(DAYS, rng.choice([2, 3])), key=DAYS.index)
+            teacher_ids = rng.sample(range(1, teachers + 1), rng.choice([1, 1, 1, 2]))
+            keys = [(t, d) for t in teacher_ids for d in days]
+            if any(
+                s < tf['end_min'] and e > tf['start_min']
+                for key in keys for s, e in busy.get(key, ())
+            ):
+                continue
+            for key in keys:
+                busy.setdefault(key, []).append((tf['start_min'], tf['end_min']))
+            rows.append((
+                rng.randint(1, courses), tf['id'], rng.randint(1, rooms), f"B{len(rows):06d}",
+                ','.join(days), ','.join(map(str, teacher_ids)), rng.random() > 0.05
+            ))
+        app.insert_batches(db, rows)
+        db.commit()
+    app.load_schedule_index()
+    return len(rows)
+
+
+class SQLCounter:
+    """Counts statements per request context through sqlite3 trace callbacks.
+
+    The count lives in a context variable rather than a thread local, so
+    statements a writer job runs on the writer thread count toward the
+    request that queued it.
+    """
+
+    def __init__(self):
+        self.current = contextvars.ContextVar('sql_count', default=None)
+
+    def install(self, app):
+        connect = app.connect_db
+
+        def counting_connect(*args):
+            conn = connect(*args)
+            conn.set_trace_callback(self.trace)
+            return conn
+
+        app.connect_db = counting_connect
+        # Drop connections opened before the callback was installed
+        app.close_idle_connections()
+
+    def trace(self, statement):
+        counter = self.current.get()
+        if counter is not None:
+            counter[0] += 1
+
+    def take(self):
+        counter = self.current.get()
+        if counter is None:
+            counter = [0]
+            self.current.set(counter)
+        count, counter[0] = counter[0], 0
+        return count
+
+
+def scenarios(rng, sizes):
+    """(name, factory) pairs; each factory returns (method, url, json body, expected statuses)"""
+    teachers, courses, rooms, timeframes, batches = sizes
+    counter = iter(range(10 ** 9))
+
+    def unique_batch():
+        return {
+            'course_id': rng.randint(1, courses),
+            'timeframe_id': rng.randint(1, timeframes),
+            'room_id': rng.randint(1, rooms),
+            'batch_number': f"N{next(counter):07d}",
+            'days': rng.sample(DAYS, 2),
+            'teacher_ids': [rng.randint(1, teachers)],
+        }
+
+    return [
+        ('GET /api/teachers', lambda: ('GET', '/api/teachers', None, (200,))),
+        ('GET /api/courses', lambda: ('GET', '/api/courses', None, (200,))),
+        ('GET /api/timeframes', lambda: ('GET', '/api/timeframes', None, (200,))),
+        ('GET /api/rooms', lambda: ('GET', '/api/rooms', None, (200,))),
+        ('GET /api/batches', lambda: ('GET', '/api/batches', None, (200,))),
+        ('GET /api/batches?limit=100', lambda: (
+            'GET', f'/api/batches?limit=100&teacher_id={rng.randint(1, teachers)}', None, (200,))),
+        ('GET /api/dashboard', lambda: (
+            'GET', f'/api/dashboard?day={rng.choice(DAYS)}&timeframe_id={rng.randint(1, timeframes)}', None, (200,))),
+        ('GET /api/teachers/<id>/schedule', lambda: (
+            'GET', f'/api/teachers/{rng.randint(1, teachers)}/schedule', None, (200,))),
+        ('GET /api/rooms/<id>/schedule', lambda: ('GET', f'/api/rooms/{rng.randint(1, rooms)}/schedule', None, (200,))),
+        ('GET /api/audit/conflicts', lambda: ('GET', '/api/audit/conflicts?kind=teacher', None, (200,))),
+        # Typeahead as it is typed: a random prefix of a teacher number
+        ('GET /api/search', lambda: (
+            'GET', '/api/search?q=teacher%20' + f'{rng.randint(0, teachers - 1):05d}'[:rng.randint(1, 5)],
+            None, (200,))),
+        ('GET /api/availability/week', lambda: ('GET', '/api/availability/week?encoding=packed', None, (200,))),
+        ('GET /api/availability/search', lambda: (
+            'GET', f'/api/availability/search?teacher_ids={rng.randint(1, teachers)},{rng.randint(1, teachers)}'
+                   f'&room_id={rng.randint(1, rooms)}&duration=90', None, (200,))),
+        # check_schedule_conflict on the write path; most random batches
+        # either conflict (409) or are created (201)
+        ('POST /api/batches', lambda: ('POST', '/api/batches', unique_batch(), (201, 409))),
+        ('PUT /api/batches/<id>', lambda: (
+            'PUT', f'/api/batches/{rng.randint(1, 50)}', {'days': rng.sample(DAYS, 2)}, (200, 404, 409))),
+        ('POST /api/batches/bulk', lambda: (
+            'POST', '/api/batches/bulk', [unique_batch() for _ in range(50)], (200,))),
+        ('POST /api/teachers', lambda: (
+            'POST', '/api/teachers', {'name': f"Bench {next(counter)}", 'phone': '0'}, (201,))),
+        ('POST /api/rooms', lambda: ('POST', '/api/rooms', {'room_number': f"BR{next(counter)}"}, (201,))),
+        ('POST /api/courses', lambda: ('POST', '/api/courses', {'name': f"Bench course {next(counter)}"}, (201,))),
+        ('POST /api/schedule/solve', lambda: ('POST', '/api/schedule/solve', {
+            'requests': [{
+                'course_id': rng.randint(1, courses),
+                'batch_number': f"S{next(counter):07d}",
+                'teacher_ids': rng.sample(range(1, teachers + 1), 3),
+                'days_required': 2,
+            } for _ in range(20)],
+            'time_budget': 0.2,
+        }, (200,))),
+        # Rooms, courses and timeframes in use answer 400 instead of deleting
+        ('DELETE /api/batches/<id>', lambda: ('DELETE', f'/api/batches/{rng.randint(1, batches)}', None, (200,))),
+        ('DELETE /api/teachers/<id>', lambda: ('DELETE', f'/api/teachers/{rng.randint(1, teachers)}', None, (200,))),
+        ('DELETE /api/rooms/<id>', lambda: ('DELETE', f'/api/rooms/{rng.randint(1, rooms)}', None, (200, 400))),
+        ('DELETE /api/courses/<id>', lambda: ('DELETE', f'/api/courses/{rng.randint(1, courses)}', None, (200, 400))),
+        ('DELETE /api/timeframes/<id>', lambda: (
+            'DELETE', f'/api/timeframes/{rng.randint(1, timeframes)}', None, (200, 400))),
+    ]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def run_scenario(app, sql, factory, requests, concurrency, cold):
+    latencies, statements, unexpected = [], [], 0
+    lock = threading.Lock()
+
+    def one(_):
+        nonlocal unexpected
+        method, url, body, expected = factory()
+        if cold:
+            # Defeat the ETag response cache so the query itself is measured
+            for table in app.GENERATION_TABLES:
+                app.bump_generation(table)
+        client = app.app.test_client()
+        sql.take()
+        started = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        response.get_data()
+        elapsed = (time.perf_counter() - started) * 1000
+        count = sql.take()
+        with lock:
+            latencies.append(elapsed)
+            statements.append(count)
+            if response.status_code not in expected:
+                unexpected += 1
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(requests)))
+    else:
+        for i in range(requests):
+            one(i)
+    wall = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "throughput_rps": round(requests / wall, 1),
+        "sql_per_request": round(statistics.fmean(statements), 2),
+        "unexpected_status": unexpected,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--teachers', type=int)
+    parser.add_argument('--batches', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=100, help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=1, help="threads for the concurrent load pass")
+    parser.add_argument('--only', help="comma-separated substrings; run matching scenarios only")
+    parser.add_argument('--cold', action='store_true', help="bypass the list response cache")
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+
+    teachers, courses, rooms, timeframes, batches = SIZES[args.size]
+    teachers = args.teachers or teachers
+    batches = args.batches or batches
+    sizes = (teachers, courses, rooms, timeframes, batches)
+
+    workdir = tempfile.mkdtemp(prefix='scheduler-bench-')
+    os.environ['DATABASE'] = os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    app.create_app()
+
+    started = time.perf_counter()
+    created = generate(*sizes, seed=args.seed)
+    print(f"generated {teachers} teachers, {created} batches in {time.perf_counter() - started:.1f}s")
+
+    sql = SQLCounter()
+    sql.install(app)
+    rng = random.Random(args.seed)
+
+    results = {}
+    for name, factory in scenarios(rng, sizes):
+        if args.only and not any(part in name for part in args.only.split(',')):
+            continue
+        passes = {"sequential": run_scenario(app, sql, factory, args.requests, 1, args.cold)}
+        if args.concurrency > 1:
+            passes["concurrent"] = run_scenario(app, sql, factory, args.requests, args.concurrency, args.cold)
+        results[name] = passes
+        seq = passes["sequential"]
+        print(f"{name:32s} p50 {seq['p50_ms']:8.2f}ms  p95 {seq['p95_ms']:8.2f}ms  "
+              f"p99 {seq['p99_ms']:8.2f}ms  {seq['throughput_rps']:8.1f} req/s  "
+              f"{seq['sql_per_request']:6.1f} sql/req")
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "size": args.size,
+            "teachers": teachers,
+            "courses": courses,
+            "rooms": rooms,
+            "timeframes": timeframes,
+            "batches": created,
+            "seed": args.seed,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "cold": args.cold,
+        },
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
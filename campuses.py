@@ -0,0 +1,51 @@
+"""Request routing for multi-campus mode.
+
+Every campus has its own database file. A request names its campus either
+with a ``/campus/<name>`` URL prefix, which PrefixMiddleware strips before
+Flask routes the request, or with an ``X-Campus`` header; the prefix is
+what browsers use, since EventSource cannot send headers.
+"""
+import re
+
+# WSGI environ key holding the campus named by the URL prefix
+ENVIRON_KEY = 'scheduler.campus'
+HEADER = 'X-Campus'
+
+NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+PREFIX = re.compile(r'^/campus/([A-Za-z0-9_-]+)(?=/|$)')
+
+
+def parse(spec):
+    """Parse a "name=path,name=path" setting into an ordered {name: path}"""
+    campuses = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, sep, path = item.partition('=')
+        name, path = name.strip(), path.strip()
+        if not sep or not path or not NAME.match(name):
+            raise ValueError(f"Invalid campus entry {item.strip()!r}, expected name=path")
+        if name in campuses:
+            raise ValueError(f"Campus {name!r} is listed twice")
+        campuses[name] = path
+    return campuses
+
+
+class PrefixMiddleware:
+    """Serve ``/campus/<name>/...`` as ``/...`` with the name in the environ.
+
+    The prefix moves into SCRIPT_NAME, so routes, url_for and the static
+    frontend work unchanged under every campus.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        match = PREFIX.match(path)
+        if match:
+            environ[ENVIRON_KEY] = match.group(1)
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + match.group(0)
+            environ['PATH_INFO'] = path[match.end():] or '/'
+        return self.app(environ, start_response)
@@ -0,0 +1,121 @@
+"""Change feed behind /api/events.
+
+Write routes append compact change records to the ``change_events`` table
+and advance a sequence number shared by every worker process. Each process
+runs one dispatcher thread that notices the sequence move, reads the new
+rows once and wakes its own subscribers, so a write made in any worker
+reaches every open stream with one query per process rather than per client.
+"""
+from collections import deque
+import json
+import threading
+import time
+
+from perprocess import PerProcess
+
+# Rows kept in change_events; older ones are pruned as new ones arrive
+LOG_SIZE = 10000
+
+
+class ChangeFeed:
+    """Fan-out of change records to Server-Sent Events subscribers.
+
+    ``connect`` opens a database connection for the dispatcher thread and
+    ``sequence`` is a process-shared integer (multiprocessing.RawValue)
+    holding the id of the newest record.
+    """
+
+    def __init__(self, connect, sequence, buffer_size=1000, poll_interval=0.2):
+        self.connect = connect
+        self.sequence = sequence
+        self.poll_interval = poll_interval
+        self._buffer = deque(maxlen=buffer_size)   # (id, record), oldest first
+        self._condition = threading.Condition()
+        self._last_id = None
+        self._dispatcher = PerProcess(self._start)
+
+    def record(self, db, entity, op, id=None, data=None):
+        """Store a change record in the caller's transaction; returns its id.
+
+        Subscribers only hear about it once advance() is called with the id
+        after the transaction has committed.
+        """
+        cursor = db.execute(
+            "INSERT INTO change_events (entity, op, entity_id, data) VALUES (?, ?, ?, ?)",
+            (entity, op, id, json.dumps(data) if data is not None else None)
+        )
+        event_id = cursor.lastrowid
+        if event_id % 500 == 0:
+            db.execute("DELETE FROM change_events WHERE id <= ?", (event_id - LOG_SIZE,))
+        return event_id
+
+    def advance(self, event_id):
+        # Ids are handed out inside the write transaction, so they commit in order
+        if event_id > self.sequence.value:
+            self.sequence.value = event_id
+
+    def _start(self):
+        with self._condition:
+            self._buffer.clear()
+            db = self.connect()
+            self._last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM change_events").fetchone()[0]
+        threading.Thread(target=self._run, args=(db,), name='change-feed', daemon=True).start()
+
+    def _run(self, db):
+        while True:
+            time.sleep(self.poll_interval)
+            if self.sequence.value <= self._last_id:
+                continue
+            try:
+                rows = db.execute(
+                    "SELECT id, entity, op, entity_id, data FROM change_events WHERE id > ? ORDER BY id",
+                    (self._last_id,)
+                ).fetchall()
+            except Exception:
+                continue
+            if not rows:
+                continue
+            with self._condition:
+                for row in rows:
+                    self._buffer.append((row[0], {
+                        "entity": row[1],
+                        "op": row[2],
+                        "id": row[3],
+                        "data": json.loads(row[4]) if row[4] is not None else None
+                    }))
+                self._last_id = rows[-1][0]
+                self._condition.notify_all()
+
+    def latest(self):
+        self._dispatcher.get()
+        return self._last_id
+
+    def subscribe(self, last_id=None, heartbeat=15.0, max_seconds=None):
+        """Yield (id, record) for every change after ``last_id``.
+
+        Yields None when nothing happened for ``heartbeat`` seconds so the
+        caller can keep the connection alive. A ``last_id`` that has already
+        left the buffer yields a single (id, {"op": "reset"}) record, after
+        which the client should reload everything.
+        """
+        self._dispatcher.get()
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        with self._condition:
+            missed = (last_id is not None and last_id < self._last_id
+                      and (not self._buffer or self._buffer[0][0] > last_id + 1))
+            if last_id is None or last_id > self._last_id or missed:
+                last_id = self._last_id
+        if missed:
+            yield last_id, {"entity": None, "op": "reset", "id": None, "data": None}
+
+        while deadline is None or time.monotonic() < deadline:
+            with self._condition:
+                if self._last_id <= last_id:
+                    self._condition.wait(heartbeat)
+                pending = [(id, record) for id, record in self._buffer if id > last_id]
+            if not pending:
+                yield None
+                continue
+            for id, record in pending:
+                yield id, record
+            last_id = pending[-1][0]
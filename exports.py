@@ -0,0 +1,104 @@
+"""CSV and iCalendar serialization for the schedule exports.
+
+Both writers are generators over row iterables and hand out text a chunk at
+a time, so a streamed response never holds the whole export in memory.
+"""
+import csv
+import io
+from datetime import datetime, timedelta
+
+# Columns of the schedule CSV, shared by the export and the import. List
+# values (days, teacher ids and names) are separated by ';'.
+CSV_COLUMNS = (
+    'id', 'course', 'batch_number', 'timeframe', 'start_time', 'end_time',
+    'room', 'days', 'teacher_ids', 'teacher_names', 'active'
+)
+
+ICAL_DAYS = {
+    'Monday': 'MO', 'Tuesday': 'TU', 'Wednesday': 'WE', 'Thursday': 'TH',
+    'Friday': 'FR', 'Saturday': 'SA', 'Sunday': 'SU'
+}
+DAY_NUMBERS = {day: i for i, day in enumerate(ICAL_DAYS)}
+
+
+def iter_csv(header, rows, chunk_rows=500):
+    """Yield CSV text for ``header`` followed by ``rows``, ``chunk_rows`` rows at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def split_list(value):
+    """Items of a ';'- or ','-separated CSV cell"""
+    return [item.strip() for item in value.replace(';', ',').split(',') if item.strip()]
+
+
+def ical_text(value):
+    """Escape a TEXT property value (RFC 5545 3.3.11)"""
+    return (str(value).replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def ical_line(line):
+    """Fold a content line at 75 octets and terminate it with CRLF"""
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts = []
+    while encoded:
+        # Never split inside a UTF-8 sequence; continuation lines start with a space
+        size = 75 if not parts else 74
+        while size < len(encoded) and (encoded[size] & 0xC0) == 0x80:
+            size -= 1
+        parts.append(encoded[:size].decode())
+        encoded = encoded[size:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def week_start(day):
+    """The Monday on or before ``day``"""
+    return day - timedelta(days=day.weekday())
+
+
+def iter_calendar(name, events, anchor, stamp):
+    """Yield an iCalendar feed of weekly recurring events.
+
+    ``events`` yields dicts with uid, summary, location, description, days
+    (day names), start_min and end_min. Each series starts on its first
+    day on or after ``anchor`` (a date) and repeats weekly on every listed
+    day; times are floating local times. ``stamp`` is the DTSTAMP (UTC).
+    """
+    yield ical_line('BEGIN:VCALENDAR')
+    yield ical_line('VERSION:2.0')
+    yield ical_line('PRODID:-//Teacher Scheduler//Schedule Export//EN')
+    yield ical_line('CALSCALE:GREGORIAN')
+    yield ical_line(f'X-WR-CALNAME:{ical_text(name)}')
+    dtstamp = stamp.strftime('%Y%m%dT%H%M%SZ')
+    for event in events:
+        days = [day for day in event['days'] if day in ICAL_DAYS]
+        if not days or event['start_min'] is None or event['end_min'] is None:
+            continue
+        first = anchor + timedelta(days=min((DAY_NUMBERS[day] - anchor.weekday()) % 7 for day in days))
+        midnight = datetime(first.year, first.month, first.day)
+        start = midnight + timedelta(minutes=event['start_min'])
+        end = midnight + timedelta(minutes=event['end_min'])
+        yield ''.join(ical_line(line) for line in (
+            'BEGIN:VEVENT',
+            f"UID:{event['uid']}",
+            f'DTSTAMP:{dtstamp}',
+            f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+            f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}",
+            f"RRULE:FREQ=WEEKLY;BYDAY={','.join(ICAL_DAYS[day] for day in days)}",
+            f"SUMMARY:{ical_text(event['summary'])}",
+            f"LOCATION:{ical_text(event['location'])}",
+            f"DESCRIPTION:{ical_text(event['description'])}",
+            'END:VEVENT',
+        ))
+    yield ical_line('END:VCALENDAR')
@@ -0,0 +1,66 @@
+"""Production server settings; every value can be overridden from the environment.
+
+The app is preloaded, so wsgi.py (schema migration and the schedule index
+build) runs once in the master, and the workers fork with the write
+generations shared between them. Send HUP for a graceful restart of all
+workers, TTIN/TTOU to add or remove one.
+
+Workers dump their metrics to METRICS_DIR (a temporary directory unless
+set), so /api/metrics reports the whole server whichever worker answers.
+"""
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import metrics
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# Each open /api/events stream holds one thread until EVENTS_MAX_STREAM_SECONDS;
+# EVENTS_MAX_STREAMS (half the threads by default) caps them per worker
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+preload_app = True
+
+# Seconds a silent worker may live, and how long workers get to finish
+# in-flight requests on restart or shutdown
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Recycle workers periodically; the jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+# Set before the app is preloaded, which reads it into its config
+_own_metrics_dir = not os.environ.get('METRICS_DIR')
+if _own_metrics_dir:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='scheduler-metrics-')
+metrics_dir = os.environ['METRICS_DIR']
+
+
+def on_starting(server):
+    # Series left by a previous master's workers would be counted again
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
+
+
+def worker_exit(server, worker):
+    metrics.dump(metrics_dir)
+
+
+def child_exit(server, worker):
+    metrics.retire(metrics_dir, worker.pid)
+
+
+def on_exit(server):
+    if _own_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,314 @@
+"""Low-overhead request and SQL instrumentation exposed in Prometheus text format.
+
+Every process keeps its own series. Under a pre-forking server a scrape
+reaches one worker at a time, so workers also dump their series to a
+shared directory (``export``) and the scraped worker renders the sum of
+all of them (``render(directory)``). The series of workers that have exited
+are folded into one file (``retire``), so totals never go backwards.
+"""
+from bisect import bisect_left
+import contextvars
+import fcntl
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds; shared by every histogram
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# SQLite invokes the progress handler every this many VM instructions
+VM_STEP_INTERVAL = 1000
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            series[0][bisect_left(BUCKETS, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        """{label values: (bucket counts, sum, count)}"""
+        with self._lock:
+            return {key: (counts[:], total, count) for key, (counts, total, count) in self._series.items()}
+
+    def render(self, series=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        if series is None:
+            series = self.collect()
+        for label_values, (counts, total, count) in sorted(series.items()):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket
+                le = _labels(self.labels + ('le',), label_values + (str(bound),))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {total:.6f}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self):
+        """{label values: value}"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        if values is None:
+            values = self.collect()
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+
+class CallbackCounter:
+    """Counter whose value is read from a callable at scrape time"""
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def collect(self):
+        return {(): self.read()}
+
+    def render(self, values=None):
+        value = self.read() if values is None else values.get((), 0)
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {value:g}"]
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+request_seconds = Histogram(
+    'scheduler_request_duration_seconds', 'Request latency by endpoint', ('endpoint', 'method', 'status'))
+sql_statements = Counter(
+    'scheduler_sql_statements_total', 'SQL statements executed, by endpoint', ('endpoint',))
+sql_seconds = Counter(
+    'scheduler_sql_seconds_total', 'Time spent executing SQL statements, by endpoint', ('endpoint',))
+sql_vm_steps = Counter(
+    'scheduler_sql_vm_steps_total',
+    'Approximate SQLite VM instructions (a proxy for rows scanned), by endpoint', ('endpoint',))
+conflict_check_seconds = Histogram(
+    'scheduler_conflict_check_duration_seconds', 'check_schedule_conflict duration')
+
+REGISTRY = [request_seconds, sql_statements, sql_seconds, sql_vm_steps, conflict_check_seconds]
+
+
+class RequestStats:
+    __slots__ = ('started', 'statements', 'sql_time', 'vm_steps', 'log')
+
+    def __init__(self, keep_log):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_time = 0.0
+        self.vm_steps = 0
+        self.log = [] if keep_log else None
+
+
+# Stats of the request being served. A context variable rather than a
+# thread local: writer jobs run in a copy of the request's context, so the
+# statements they run on the writer thread count toward the request.
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def start_request(keep_log=False):
+    stats = RequestStats(keep_log)
+    _current.set(stats)
+    return stats
+
+
+def finish_request():
+    stats = _current.get()
+    _current.set(None)
+    return stats
+
+
+def _trace(statement):
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+
+
+def _progress():
+    stats = _current.get()
+    if stats is not None:
+        stats.vm_steps += VM_STEP_INTERVAL
+    return 0
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that times execute/executemany for the current request"""
+
+    def _timed(self, method, sql, *args):
+        stats = _current.get()
+        if stats is None:
+            return method(sql, *args)
+        started = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.sql_time += elapsed
+            if stats.log is not None and len(stats.log) < 100:
+                stats.log.append((elapsed, ' '.join(sql.split())))
+
+    def execute(self, sql, *args):
+        return self._timed(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(super().executemany, sql, *args)
+
+
+def instrument(conn):
+    """Attach the statement counter and VM step sampler to a new connection"""
+    conn.set_trace_callback(_trace)
+    conn.set_progress_handler(_progress, VM_STEP_INTERVAL)
+    return conn
+
+
+# Dump file in an export directory holding the series of exited workers
+RETIRED = 'retired.json'
+
+
+def _add(a, b):
+    """Sum two collected values: numbers, or histogram (counts, sum, count)"""
+    if a is None:
+        return b
+    if isinstance(a, (list, tuple)):
+        return [_add(x, y) for x, y in zip(a, b)]
+    return a + b
+
+
+def _merge(merged, state):
+    for name, series in state.items():
+        target = merged.get(name)
+        if target is None:
+            continue
+        for label_values, value in series:
+            key = tuple(label_values)
+            target[key] = _add(target.get(key), value)
+
+
+def _serialize(series):
+    return [[list(key), value] for key, value in series.items()]
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Not written yet, or retired meanwhile
+        return {}
+
+
+def _write(path, state):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(temporary, path)
+
+
+class _DirectoryLock:
+    """flock on the export directory, so a scrape never sees a retiring
+    worker's series twice or not at all"""
+
+    def __init__(self, directory, exclusive=False):
+        self.path = os.path.join(directory, '.lock')
+        self.operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, self.operation)
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+
+def _dump_path(directory, pid=None):
+    return os.path.join(directory, f"{pid or os.getpid()}.json")
+
+
+def dump(directory):
+    """Write this process's series to its file in ``directory``"""
+    _write(_dump_path(directory), {metric.name: _serialize(metric.collect()) for metric in REGISTRY})
+
+
+def export(directory, interval=1.0):
+    """Start a thread dumping this process's series to ``directory`` every ``interval`` seconds"""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(directory)
+            except OSError:
+                pass
+
+    threading.Thread(target=run, name='metrics-export', daemon=True).start()
+
+
+def retire(directory, pid):
+    """Fold the dump of exited process ``pid`` into the retired series"""
+    path = _dump_path(directory, pid)
+    with _DirectoryLock(directory, exclusive=True):
+        state = _load(path)
+        if not state:
+            return
+        retired_path = os.path.join(directory, RETIRED)
+        retired = _load(retired_path)
+        merged = {name: {} for name in {*retired, *state}}
+        _merge(merged, retired)
+        _merge(merged, state)
+        _write(retired_path, {name: _serialize(series) for name, series in merged.items()})
+        os.remove(path)
+
+
+def render(directory=None):
+    """Prometheus text for this process, or with ``directory`` for every
+    process that dumps there (this one counted live, not from its file)"""
+    merged = {metric.name: metric.collect() for metric in REGISTRY}
+    if directory:
+        own = _dump_path(directory)
+        with _DirectoryLock(directory):
+            for path in glob.glob(os.path.join(directory, '*.json')):
+                if path != own:
+                    _merge(merged, _load(path))
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render(merged[metric.name]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,60 @@
+"""Ordered schema migrations keyed on PRAGMA user_version.
+
+A migration is a (version, description, apply) tuple. ``apply(db)`` runs
+inside a BEGIN IMMEDIATE transaction that also records the new
+user_version, so each step is applied completely or not at all. Steps
+that rewrite large tables can instead be generators: every ``yield``
+marks a finished chunk, which is committed before the next one starts so
+the write lock is never held for long. Such steps must be safe to
+restart; the version is only recorded once the last chunk is done.
+"""
+import inspect
+import time
+
+
+def current_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def latest_version(migrations):
+    return migrations[-1][0] if migrations else 0
+
+
+def pending(db, migrations, target=None):
+    """The (version, description, apply) steps still to run, in order"""
+    version = current_version(db)
+    target = latest_version(migrations) if target is None else target
+    return [step for step in migrations if version < step[0] <= target]
+
+
+def migrate(db, migrations, target=None, log=None):
+    """Apply every pending step up to ``target`` (default: the latest).
+
+    Returns the versions applied. An up-to-date database costs a single
+    PRAGMA read. Several processes may call this at once; a step another
+    process finished first is skipped.
+    """
+    log = log or (lambda message, *args: None)
+    applied = []
+    for version, description, apply in pending(db, migrations, target):
+        started = time.perf_counter()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if current_version(db) >= version:
+                db.rollback()
+                continue
+            result = apply(db)
+            if inspect.isgenerator(result):
+                for chunk, rows in enumerate(result, 1):
+                    db.commit()
+                    log("migration %d: chunk %d done (%s rows)", version, chunk, rows)
+                    db.execute("BEGIN IMMEDIATE")
+            db.execute(f"PRAGMA user_version = {int(version)}")
+            db.commit()
+        except BaseException:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        log("migration %d applied in %.2fs: %s", version, time.perf_counter() - started, description)
+        applied.append(version)
+    return applied
@@ -0,0 +1,31 @@
+"""State that every worker process sets up for itself on first use.
+
+Threads, thread pools and open connections do not survive a fork: a
+pre-forked gunicorn worker inherits the objects but none of the threads
+behind them. Background machinery is therefore started lazily, the first
+time each process needs it, rather than at import or in ``create_app``.
+"""
+import os
+import threading
+
+
+class PerProcess:
+    """Calls ``start()`` once in each process that asks for it.
+
+    ``get()`` returns what ``start`` returned in the calling process,
+    starting it first if this process has not yet done so.
+    """
+
+    def __init__(self, start):
+        self._start = start
+        self._lock = threading.Lock()
+        self._pid = None
+        self._value = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self._start()
+                    self._pid = os.getpid()
+        return self._value
@@ -0,0 +1,210 @@
+"""In-memory interval index of teacher and room occupancy used for conflict checks"""
+from bisect import bisect_left, bisect_right, insort
+from heapq import heappop, heappush
+import threading
+
+TEACHER = 'teacher'
+ROOM = 'room'
+
+
+def sweep_overlaps(intervals):
+    """Every overlapping pair in a start-sorted list of (start, end, batch_id).
+
+    One sweep keeps the intervals still open in a heap ordered by end, so
+    the cost is O(n log n + k) for k overlapping pairs. Returns
+    (first_batch_id, second_batch_id, overlap_start, overlap_end) tuples.
+    """
+    open_intervals = []   # heap of (end, start, batch_id)
+    pairs = []
+    for start, end, batch_id in intervals:
+        while open_intervals and open_intervals[0][0] <= start:
+            heappop(open_intervals)
+        for other_end, other_start, other_id in open_intervals:
+            pairs.append((other_id, batch_id, start, min(end, other_end)))
+        heappush(open_intervals, (end, start, batch_id))
+    return pairs
+
+
+def overlaps_involving(intervals, batch_ids):
+    """Overlapping pairs in a start-sorted list of (start, end, batch_id) with a batch in ``batch_ids``.
+
+    Pairs of other batches are skipped without being looked at, so the
+    cost follows the number of listed batches rather than the list.
+    Returns {(smaller_id, larger_id): tuple as from sweep_overlaps}.
+    """
+    pairs = {}
+    for start, end, batch_id in intervals:
+        if batch_id not in batch_ids:
+            continue
+        for other_start, other_end, other_id in intervals:
+            if other_start >= end:
+                break
+            if other_end > start and other_id != batch_id:
+                key = (min(batch_id, other_id), max(batch_id, other_id))
+                if key not in pairs:
+                    first, second = (other_id, batch_id) if (other_start, other_end) <= (start, end) else (batch_id, other_id)
+                    pairs[key] = (first, second, max(start, other_start), min(end, other_end))
+    return pairs
+
+
+class ScheduleIndex:
+    """Per (resource, day) sorted arrays of (start_minute, end_minute, batch_id).
+
+    Resources are teachers and rooms. The index only holds active batches.
+    It is built once from the database and then kept current by the batch
+    write routes, so the read-side views never have to query SQLite for
+    occupancy; write-path conflict checks use the occupancy table. ``version``
+    increases on every change so derived structures know when to rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._intervals = {}    # (kind, resource_id, day) -> sorted [(start, end, batch_id)]
+        self._max_length = {}   # (kind, resource_id, day) -> longest interval ever stored
+        self._batches = {}      # batch_id -> (keys, start, end, timeframe_id)
+        self.timeframes = {}    # timeframe_id -> (start, end, timeframe label)
+        self.version = 0
+        self.scanned = 0        # intervals inspected by overlap queries, for metrics
+        self.loaded = False
+
+    def load(self, timeframes, batches):
+        """Rebuild the index.
+
+        ``timeframes`` yields (id, start_minute, end_minute, label) and
+        ``batches`` yields (batch_id, timeframe_id, teacher_ids, days, active,
+        room_id).
+        """
+        with self._lock:
+            self._intervals = {}
+            self._max_length = {}
+            self._batches = {}
+            self.timeframes = {}
+            for timeframe_id, start, end, label in timeframes:
+                self.set_timeframe(timeframe_id, start, end, label)
+            for batch in batches:
+                self.add_batch(*batch)
+            self.loaded = True
+
+    def set_timeframe(self, timeframe_id, start, end, label):
+        with self._lock:
+            self.timeframes[int(timeframe_id)] = (start, end, label)
+            self.version += 1
+
+    def remove_timeframe(self, timeframe_id):
+        with self._lock:
+            self.timeframes.pop(int(timeframe_id), None)
+            self.version += 1
+
+    def add_batch(self, batch_id, timeframe_id, teacher_ids, days, active=True, room_id=None):
+        """Index a batch, replacing whatever was stored for it before"""
+        with self._lock:
+            self.remove_batch(batch_id)
+            timeframe = self.timeframes.get(int(timeframe_id))
+            if not active or not timeframe or timeframe[0] is None or timeframe[1] is None:
+                return
+            start, end = timeframe[0], timeframe[1]
+            keys = self._keys(teacher_ids, days, room_id)
+            for key in keys:
+                insort(self._intervals.setdefault(key, []), (start, end, batch_id))
+                self._max_length[key] = max(self._max_length.get(key, 0), end - start)
+            self._batches[batch_id] = (keys, start, end, int(timeframe_id))
+            self.version += 1
+
+    @staticmethod
+    def _keys(teacher_ids, days, room_id):
+        keys = [(TEACHER, int(teacher_id), day) for teacher_id in teacher_ids for day in days]
+        if room_id is not None:
+            keys += [(ROOM, int(room_id), day) for day in days]
+        return list(dict.fromkeys(keys))
+
+    def what_if(self, removed, added):
+        """Interval lists before and after proposed changes, leaving the index as it is.
+
+        ``removed`` holds batch ids to take out and ``added`` yields
+        add_batch() argument tuples to put in; a batch in both is moved.
+        Only the (kind, resource_id, day) lists the changes touch are
+        copied. Returns {key: (before, after)} with both lists sorted.
+        """
+        with self._lock:
+            additions = []
+            for batch_id, timeframe_id, teacher_ids, days, active, room_id in added:
+                timeframe = self.timeframes.get(int(timeframe_id))
+                if not active or not timeframe or timeframe[0] is None or timeframe[1] is None:
+                    continue
+                additions.append((batch_id, self._keys(teacher_ids, days, room_id), timeframe[0], timeframe[1]))
+            removals = [(batch_id,) + self._batches[batch_id][:3] for batch_id in removed if batch_id in self._batches]
+            touched = {key for _, keys, _, _ in additions + removals for key in keys}
+            before = {key: list(self._intervals.get(key, ())) for key in touched}
+
+        after = {key: list(intervals) for key, intervals in before.items()}
+        for batch_id, keys, start, end in removals:
+            for key in keys:
+                intervals = after[key]
+                i = bisect_left(intervals, (start, end, batch_id))
+                if i < len(intervals) and intervals[i] == (start, end, batch_id):
+                    del intervals[i]
+        for batch_id, keys, start, end in additions:
+            for key in keys:
+                insort(after[key], (start, end, batch_id))
+        return {key: (before[key], after[key]) for key in touched}
+
+    def remove_batch(self, batch_id):
+        with self._lock:
+            entry = self._batches.pop(batch_id, None)
+            if not entry:
+                return
+            keys, start, end, _ = entry
+            for key in keys:
+                intervals = self._intervals.get(key)
+                if not intervals:
+                    continue
+                i = bisect_left(intervals, (start, end, batch_id))
+                if i < len(intervals) and intervals[i] == (start, end, batch_id):
+                    del intervals[i]
+                if not intervals:
+                    del self._intervals[key]
+                    self._max_length.pop(key, None)
+            self.version += 1
+
+    def _overlapping(self, key, start, end, exclude_batch_id):
+        with self._lock:
+            intervals = self._intervals.get(key)
+            if not intervals:
+                return []
+            # Anything that overlaps must start after start - longest interval
+            # and before end, so only that slice of the array is inspected
+            lo = bisect_right(intervals, (start - self._max_length[key], float('inf')))
+            hi = bisect_left(intervals, (end,))
+            self.scanned += max(0, hi - lo)
+            return [
+                interval for interval in intervals[lo:hi]
+                if interval[1] > start and interval[2] != exclude_batch_id
+            ]
+
+    def overlapping(self, teacher_id, day, start, end, exclude_batch_id=None):
+        """Return the stored intervals for (teacher, day) that overlap [start, end)"""
+        return self._overlapping((TEACHER, int(teacher_id), day), start, end, exclude_batch_id)
+
+    def entries(self, kind=TEACHER):
+        """Snapshot of every indexed (resource_id, day, start, end, batch_id) of one kind"""
+        with self._lock:
+            return [
+                (resource_id, day, start, end, batch_id)
+                for (key_kind, resource_id, day), intervals in self._intervals.items()
+                if key_kind == kind
+                for start, end, batch_id in intervals
+            ]
+
+    def conflicts(self, kind=None):
+        """(kind, resource_id, day, batch_a, batch_b, start, end) for every double booking"""
+        found = []
+        with self._lock:
+            for key, intervals in self._intervals.items():
+                if len(intervals) > 1 and (kind is None or key[0] == kind):
+                    found.extend(key + pair for pair in sweep_overlaps(intervals))
+        return found
+
+    def week(self, kind, resource_id, days):
+        """Sorted (start, end, batch_id) lists per day for one teacher or room"""
+        with self._lock:
+            return {day: list(self._intervals.get((kind, int(resource_id), day), ())) for day in days}
@@ -0,0 +1,136 @@
+"""In-memory read snapshots of a database file.
+
+Each worker process keeps a copy of the database in a shared-cache
+in-memory SQLite database, made with the online backup API. Read-only
+requests run against the copy, so their latency no longer depends on disk
+I/O or on the write lock. A background thread takes a new copy whenever
+the source's write version moves; requests that start while it works keep
+the copy they have, and the old copy is freed once its last connection is
+returned.
+
+A copy that no longer matches the source may still be used for up to
+``max_staleness`` seconds after it was taken; past that, reads fall back
+to the database file until the refresh lands. With ``max_staleness`` 0 a
+request only ever sees data as current as the file.
+"""
+from itertools import count
+import os
+import queue
+import threading
+import time
+
+from perprocess import PerProcess
+
+_names = count(1)
+
+
+class Copy:
+    """One in-memory copy and the idle connections to it"""
+
+    def __init__(self, uri, keeper, version, taken_at, pool_size):
+        self.uri = uri
+        self.keeper = keeper        # holds the database open while the copy is current
+        self.version = version      # source version the copy was taken at
+        self.taken_at = taken_at    # time.monotonic() when the backup started
+        self.pool = queue.LifoQueue()
+        self.pool_size = pool_size
+        self.retired = False
+        self.lock = threading.Lock()
+
+    def release(self, db):
+        with self.lock:
+            if not self.retired and self.pool.qsize() < self.pool_size:
+                self.pool.put(db)
+                return
+        db.close()
+
+    def retire(self):
+        with self.lock:
+            self.retired = True
+            idle = [self.keeper]
+            while not self.pool.empty():
+                idle.append(self.pool.get_nowait())
+        for db in idle:
+            db.close()
+
+
+class ReadSnapshot:
+    """In-memory copy of the database behind ``connect``.
+
+    ``connect(database)`` opens a connection; None opens the source file
+    and an in-memory URI opens the copy. ``version()`` returns a value that
+    changes with every committed write to the source, e.g. its write
+    generations.
+    """
+
+    def __init__(self, connect, version, max_staleness=0.0, pool_size=8, poll_interval=0.05):
+        self.connect = connect
+        self.version = version
+        self.max_staleness = max_staleness
+        self.pool_size = pool_size
+        self.poll_interval = poll_interval
+        self.refreshes = 0      # copies taken, for metrics
+        self.hits = 0           # connections handed out, for metrics
+        self.misses = 0         # reads sent to the file instead, for metrics
+        self._current = None
+        # Every worker makes its own copy; reads go to the file until it is ready
+        self._refresher = PerProcess(self._start)
+
+    def _start(self):
+        self._current = None
+        threading.Thread(target=self._run, name='read-snapshot', daemon=True).start()
+
+    def acquire(self):
+        """(connection, copy) for a read, or None if no copy is current enough.
+
+        Hand the connection back with ``copy.release(db)``.
+        """
+        self._refresher.get()
+        copy = self._current
+        if copy is None or (copy.version != self.version()
+                            and time.monotonic() - copy.taken_at > self.max_staleness):
+            self.misses += 1
+            return None
+        try:
+            db = copy.pool.get_nowait()
+        except queue.Empty:
+            db = self.connect(copy.uri)
+            db.execute("PRAGMA query_only = ON")
+        self.hits += 1
+        return db, copy
+
+    def refresh(self, source):
+        """Copy ``source`` into a new in-memory database and make it current"""
+        # Read the version first: a write that lands during the backup
+        # leaves the copy marked stale rather than marked current
+        version = self.version()
+        taken_at = time.monotonic()
+        uri = f"file:snapshot-{os.getpid()}-{next(_names)}?mode=memory&cache=shared"
+        keeper = self.connect(uri)
+        try:
+            source.backup(keeper)
+        except BaseException:
+            keeper.close()
+            raise
+        previous, self._current = self._current, Copy(uri, keeper, version, taken_at, self.pool_size)
+        self.refreshes += 1
+        if previous is not None:
+            previous.retire()
+
+    def _run(self):
+        source = None
+        while True:
+            copy = self._current
+            if copy is not None and copy.version == self.version():
+                time.sleep(self.poll_interval)
+                continue
+            try:
+                source = source or self.connect(None)
+                self.refresh(source)
+            except Exception:
+                # Reads keep using the file (or the old copy within its
+                # staleness bound); try again with a fresh connection
+                if source is not None:
+                    source.close()
+                source = None
+                time.sleep(1.0)
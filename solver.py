@@ -0,0 +1,299 @@
+"""Timetable generator: places unscheduled batch requests on the existing schedule.
+
+A request names a course, the teachers eligible to take it, how many of
+them are needed, how many days a week it meets and the room capacity it
+needs. The solver picks a timeframe, a room, the days and the teachers so
+that no teacher or room is double-booked, using the same overlap rule as
+check_schedule_conflict: two timeframes clash when one starts before the
+other ends.
+
+Construction is greedy (hardest requests first); the result is then
+improved by a ruin-and-recreate local search until the time budget runs
+out. Several independent searches can run in worker processes, the best
+result wins.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+import multiprocessing
+import random
+import time
+
+# The solver is called from multithreaded web workers, and forking a
+# process with other threads running (the writer, the snapshot refresher)
+# can leave the child holding a lock nobody will release. Search processes
+# start from the clean forkserver process instead, or are spawned where
+# forkserver is not available.
+_mp_context = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+ALL_DAYS = (1 << len(DAYS)) - 1
+
+TEACHER = 0
+ROOM = 1
+
+
+def _spread_key(combo):
+    # Prefer days that are not back to back (Mon/Wed/Fri over Mon/Tue/Wed)
+    adjacent = sum(1 for a, b in zip(combo, combo[1:]) if b - a == 1)
+    return adjacent, combo
+
+# For each number of days: candidate day sets as bitmasks, best spread first
+DAY_PATTERNS = {
+    n: [sum(1 << d for d in combo) for combo in sorted(combinations(range(len(DAYS)), n), key=_spread_key)]
+    for n in range(1, len(DAYS) + 1)
+}
+
+
+def _days_mask(days):
+    return sum(1 << DAYS.index(day) for day in days)
+
+
+def _mask_days(mask):
+    return [day for i, day in enumerate(DAYS) if mask >> i & 1]
+
+
+def _prepare(requests, tf_index, tf_minutes):
+    prepared = []
+    for request in requests:
+        timeframe_ids = request.get('timeframe_ids')
+        candidates = [tf_index[id] for id in timeframe_ids if id in tf_index] if timeframe_ids else list(tf_index.values())
+        duration = int(request.get('duration') or 0)
+        candidates = [tf for tf in candidates if tf_minutes[tf] >= duration]
+        prepared.append({
+            'teacher_ids': list(request['teacher_ids']),
+            'teachers_needed': int(request.get('teachers_needed', 1)),
+            'days_required': int(request['days_required']),
+            'days_mask': _days_mask(request['days']) if request.get('days') else ALL_DAYS,
+            'capacity': int(request.get('capacity') or 0),
+            'timeframes': sorted(candidates),
+        })
+    return prepared
+
+
+class Problem:
+    """Static part of a solver run; plain data so it can be sent to worker processes.
+
+    ``timeframes`` maps id -> (start_minute, end_minute), ``rooms`` maps
+    id -> capacity (None means unknown and accepts any request), and
+    ``existing`` lists (teacher_ids, room_id, timeframe_id, days) of the
+    batches already scheduled.
+    """
+
+    def __init__(self, requests, timeframes, rooms, existing):
+        self.tf_ids = sorted(timeframes, key=lambda id: timeframes[id])
+        self.tf_index = {id: i for i, id in enumerate(self.tf_ids)}
+        spans = [timeframes[id] for id in self.tf_ids]
+        self.tf_minutes = [end - start for start, end in spans]
+        self.overlaps = [
+            [j for j, (s2, e2) in enumerate(spans) if s1 < e2 and e1 > s2]
+            for s1, e1 in spans
+        ]
+        # Smallest rooms first so large rooms stay free for large batches
+        self.rooms = sorted(rooms.items(), key=lambda room: (room[1] is None, room[1] or 0, room[0]))
+        self.existing = [
+            (list(teacher_ids), room_id, self.tf_index[timeframe_id], _days_mask(days))
+            for teacher_ids, room_id, timeframe_id, days in existing
+            if timeframe_id in self.tf_index
+        ]
+        self.requests = _prepare(requests, self.tf_index, self.tf_minutes)
+
+
+class State:
+    """Occupancy of teachers and rooms as per-timeframe day bitmasks"""
+
+    def __init__(self, problem):
+        self.problem = problem
+        self.counts = {}    # (kind, id) -> [count per timeframe * 7 + day]
+        self.blocked = {}   # (kind, id) -> [days mask per timeframe]
+        self.load = {}      # teacher_id -> minutes per week
+        self.assignments = {}
+        for teacher_ids, room_id, tf, days in problem.existing:
+            self._occupy(teacher_ids, room_id, tf, days, 1)
+
+    def _resource(self, key):
+        if key not in self.blocked:
+            size = len(self.problem.tf_ids)
+            self.counts[key] = [0] * (size * len(DAYS))
+            self.blocked[key] = [0] * size
+        return self.counts[key], self.blocked[key]
+
+    def _occupy(self, teacher_ids, room_id, tf, days, delta):
+        keys = [(TEACHER, teacher_id) for teacher_id in teacher_ids] + [(ROOM, room_id)]
+        day_list = [d for d in range(len(DAYS)) if days >> d & 1]
+        for key in keys:
+            counts, blocked = self._resource(key)
+            for j in self.problem.overlaps[tf]:
+                for d in day_list:
+                    counts[j * 7 + d] += delta
+                    if counts[j * 7 + d]:
+                        blocked[j] |= 1 << d
+                    else:
+                        blocked[j] &= ~(1 << d)
+        minutes = self.problem.tf_minutes[tf] * len(day_list) * delta
+        for teacher_id in teacher_ids:
+            self.load[teacher_id] = self.load.get(teacher_id, 0) + minutes
+
+    def free_days(self, kind, id, tf):
+        blocked = self.blocked.get((kind, id))
+        return ALL_DAYS & ~blocked[tf] if blocked else ALL_DAYS
+
+    def assign(self, index, teacher_ids, room_id, tf, days):
+        self.assignments[index] = (teacher_ids, room_id, tf, days)
+        self._occupy(teacher_ids, room_id, tf, days, 1)
+
+    def unassign(self, index):
+        teacher_ids, room_id, tf, days = self.assignments.pop(index)
+        self._occupy(teacher_ids, room_id, tf, days, -1)
+
+    def place(self, index, rng=None):
+        """Greedily place one request; returns True when it found a slot"""
+        request = self.problem.requests[index]
+        needed = request['days_required']
+        patterns = DAY_PATTERNS.get(needed)
+        if not patterns:
+            return False
+        allowed_days = request['days_mask']
+
+        timeframes = request['timeframes']
+        teachers = sorted(request['teacher_ids'], key=lambda t: self.load.get(t, 0))
+        if rng:
+            timeframes = timeframes[:]
+            rng.shuffle(timeframes)
+            rng.shuffle(teachers)
+
+        for tf in timeframes:
+            # Pick the least loaded teachers that still share enough free days
+            chosen, common = [], allowed_days
+            for teacher_id in teachers:
+                shared = common & self.free_days(TEACHER, teacher_id, tf)
+                if bin(shared).count('1') >= needed:
+                    chosen.append(teacher_id)
+                    common = shared
+                    if len(chosen) == request['teachers_needed']:
+                        break
+            if len(chosen) < request['teachers_needed']:
+                continue
+
+            for room_id, capacity in self.problem.rooms:
+                if capacity is not None and capacity < request['capacity']:
+                    continue
+                free = common & self.free_days(ROOM, room_id, tf)
+                for days in patterns:
+                    if free & days == days:
+                        self.assign(index, chosen, room_id, tf, days)
+                        return True
+        return False
+
+    def objective(self):
+        """(unscheduled requests, teacher load imbalance); lower is better"""
+        unscheduled = len(self.problem.requests) - len(self.assignments)
+        return unscheduled, sum(minutes * minutes for minutes in self.load.values())
+
+
+def _difficulty(request):
+    # Few eligible teachers, many days and big rooms are the hardest to place
+    return (
+        len(request['teacher_ids']) - request['teachers_needed'],
+        len(request['timeframes']),
+        -request['days_required'],
+        -request['capacity'],
+    )
+
+
+def construct(problem, rng=None):
+    state = State(problem)
+    order = sorted(range(len(problem.requests)), key=lambda i: _difficulty(problem.requests[i]))
+    for index in order:
+        state.place(index, rng)
+    return state
+
+
+def improve(problem, state, deadline, seed, ruin_size=8):
+    """Ruin-and-recreate search: free a few placed requests near an unplaced one and retry"""
+    rng = random.Random(seed)
+    best = state.objective()
+    while time.monotonic() < deadline and best[0] > 0:
+        # A request without candidate timeframes can never be placed
+        unplaced = [
+            i for i in range(len(problem.requests))
+            if i not in state.assignments and problem.requests[i]['timeframes']
+        ]
+        if not unplaced:
+            break
+        target = rng.choice(unplaced)
+        teachers = set(problem.requests[target]['teacher_ids'])
+        related = [
+            i for i, (teacher_ids, _, _, _) in state.assignments.items()
+            if teachers.intersection(teacher_ids)
+        ]
+        related_set = set(related)
+        others = [i for i in state.assignments if i not in related_set]
+        ruined = rng.sample(related, min(len(related), ruin_size))
+        ruined += rng.sample(others, min(len(others), max(0, ruin_size - len(ruined))))
+
+        saved = {i: state.assignments[i] for i in ruined}
+        for i in ruined:
+            state.unassign(i)
+
+        retry = [target] + [i for i in unplaced if i != target] + ruined
+        placed = []
+        for i in retry:
+            if i not in state.assignments and state.place(i, rng):
+                placed.append(i)
+
+        candidate = state.objective()
+        if candidate <= best:
+            best = candidate
+            continue
+        # Worse: roll back to the saved assignments
+        for i in placed:
+            state.unassign(i)
+        for i, assignment in saved.items():
+            state.assign(i, *assignment)
+    return state
+
+
+def _search(problem, seed, deadline_seconds):
+    deadline = time.monotonic() + deadline_seconds
+    state = construct(problem, random.Random(seed) if seed else None)
+    improve(problem, state, deadline, seed)
+    return state.objective(), state.assignments
+
+
+def solve(requests, timeframes, rooms, existing, time_budget=5.0, workers=1, seed=0):
+    """Place ``requests`` on top of ``existing`` within ``time_budget`` seconds.
+
+    Returns a dict with ``assignments`` (one entry per placed request, with
+    the request index, timeframe_id, room_id, days and teacher_ids) and
+    ``unscheduled`` (indexes of requests that could not be placed).
+    """
+    started = time.monotonic()
+    problem = Problem(requests, timeframes, rooms, existing)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context) as pool:
+            futures = [
+                pool.submit(_search, problem, seed + i, time_budget)
+                for i in range(workers)
+            ]
+            results = [future.result() for future in futures]
+        best_objective, assignments = min(results, key=lambda result: result[0])
+    else:
+        best_objective, assignments = _search(problem, seed, time_budget)
+
+    return {
+        "assignments": [
+            {
+                "request": index,
+                "timeframe_id": problem.tf_ids[tf],
+                "room_id": room_id,
+                "days": _mask_days(days),
+                "teacher_ids": list(teacher_ids),
+            }
+            for index, (teacher_ids, room_id, tf, days) in sorted(assignments.items())
+        ],
+        "unscheduled": [i for i in range(len(requests)) if i not in assignments],
+        "elapsed": round(time.monotonic() - started, 3),
+    }
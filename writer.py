@@ -0,0 +1,150 @@
+"""Single writer thread with group commit.
+
+Write routes hand their database work to one thread per process as a
+callable that receives the writer's connection. The thread takes
+everything queued at that moment, runs each job under its own SAVEPOINT
+inside one BEGIN IMMEDIATE transaction and commits once, so a burst of
+concurrent writes costs one lock acquisition and one fsync instead of one
+each. A job that raises is rolled back to its savepoint alone and the
+exception is re-raised in the caller; the rest of the group still commits.
+
+Because a job's reads and writes share the write transaction, a check
+followed by an insert inside one job is atomic, also across worker
+processes. Readers keep using their own connections and see each group
+as soon as it commits (WAL).
+
+Jobs run in a copy of the submitting thread's context, so context
+variables the caller had set (such as its campus) are visible to them.
+
+In-memory state derived from the database (such as the schedule index)
+is updated from ``after_commit`` callbacks, which the writer thread runs
+in commit order once the group is durable and before any of its callers
+resume. Updating it from the callers instead would apply concurrent
+writes in whatever order their threads happen to wake up.
+"""
+from concurrent.futures import Future
+import contextvars
+import queue
+import threading
+
+from perprocess import PerProcess
+
+
+class WriteQueue:
+    """Serializes write jobs through one connection opened by ``connect``"""
+
+    def __init__(self, connect, max_group=64):
+        self.connect = connect
+        self.max_group = max_group
+        self.groups = 0   # committed transactions, for metrics
+        self.jobs = 0     # jobs run, for metrics
+        self._queue = queue.Queue()
+        self._thread = PerProcess(self._start)
+        self._callbacks = None  # after_commit callbacks of the running job
+
+    def _start(self):
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name='db-writer', daemon=True).start()
+
+    def submit(self, job, *args):
+        """Queue ``job(db, *args)``; the Future resolves once its group has committed"""
+        self._thread.get()
+        future = Future()
+        self._queue.put((future, job, args, contextvars.copy_context()))
+        return future
+
+    def run(self, job, *args):
+        """Run ``job(db, *args)`` in the next group and return its result"""
+        return self.submit(job, *args).result()
+
+    def after_commit(self, callback, *args):
+        """Call ``callback(*args)`` once the running job's group has committed.
+
+        Only valid inside a job. Callbacks of a job that is rolled back are
+        dropped; one that raises fails its job's future, although the job's
+        writes have been committed.
+        """
+        if self._callbacks is None:
+            raise RuntimeError("after_commit() called outside a write job")
+        self._callbacks.append((callback, args))
+
+    def _run(self):
+        db = self.connect()
+        while True:
+            group = [self._queue.get()]
+            while len(group) < self.max_group:
+                try:
+                    group.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit_group(db, group)
+            except Exception as e:
+                # Never leave a caller waiting on a job the thread gave up on
+                if db.in_transaction:
+                    db.rollback()
+                for future, *_ in group:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit_group(self, db, group):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            for future, *_ in group:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        done = []
+        for future, job, args, context in group:
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.jobs += 1
+            db.execute("SAVEPOINT job")
+            self._callbacks = callbacks = []
+            try:
+                result = context.run(job, db, *args)
+            except BaseException as e:
+                if db.in_transaction:
+                    db.execute("ROLLBACK TO job")
+                    db.execute("RELEASE job")
+                    future.set_exception(e)
+                    continue
+                # SQLite abandoned the whole transaction (e.g. disk full);
+                # nothing done so far survived, so start over for the rest
+                future.set_exception(e)
+                for earlier, *_ in done:
+                    earlier.set_exception(e)
+                done = []
+                db.execute("BEGIN IMMEDIATE")
+                continue
+            finally:
+                self._callbacks = None
+            db.execute("RELEASE job")
+            done.append((future, result, context, callbacks))
+
+        try:
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            for future, *_ in done:
+                future.set_exception(e)
+            return
+        self.groups += 1
+        # Apply every job's callbacks first, so no caller resumes before the
+        # whole group is reflected in memory
+        errors = []
+        for future, result, context, callbacks in done:
+            error = None
+            for callback, args in callbacks:
+                try:
+                    context.run(callback, *args)
+                except Exception as e:
+                    error = error or e
+            errors.append(error)
+        for (future, result, *_), error in zip(done, errors):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)